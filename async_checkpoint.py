@@ -0,0 +1,52 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, List
+
+import torch
+
+'''
+Background checkpoint writer. The recipe snapshots the tensors that keep changing during
+training (LoRA adapter and optimizer state) on the main thread, then hands the LoRA merge
+and the safetensors serialization to a single worker thread so the next epoch can start
+right away. At most ``max_pending`` saves are in flight; submitting another one first
+waits for the oldest, which bounds the host memory held by snapshots.
+'''
+
+
+def snapshot_to_cpu(obj: Any) -> Any:
+    """Copy every tensor in a (possibly nested) dict, list or tuple to a fresh CPU tensor."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {k: snapshot_to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot_to_cpu(v) for v in obj)
+    return obj
+
+
+class AsyncCheckpointer:
+    """
+    Runs checkpoint saves on a background thread.
+
+    Args:
+        max_pending (int): maximum number of saves in flight. Default 1
+    """
+
+    def __init__(self, max_pending: int = 1) -> None:
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="checkpoint")
+        self._max_pending = max_pending
+        self._pending: List[Future] = []
+
+    def submit(self, fn: Callable, *args, **kwargs) -> None:
+        """Schedule ``fn(*args, **kwargs)``, first waiting for older saves beyond ``max_pending``."""
+        while len(self._pending) >= self._max_pending:
+            self._pending.pop(0).result()
+        self._pending.append(self._executor.submit(fn, *args, **kwargs))
+
+    def wait(self) -> None:
+        """Block until every scheduled save has finished, re-raising the first error."""
+        while self._pending:
+            self._pending.pop(0).result()
+
+    def close(self) -> None:
+        self.wait()
+        self._executor.shutdown()
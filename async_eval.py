@@ -0,0 +1,53 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Optional
+
+import torch
+from torch import nn
+
+'''
+Off-critical-path evaluation. The eval model is a second copy of the LoRA model that lives
+on its own device (a spare GPU or the CPU) with the frozen base weights loaded once. At
+every eval step the trainer copies only the adapter weights to that device; a background
+thread then loads them into the eval model and runs generation while training continues.
+'''
+
+
+class AsyncEvaluator:
+    """
+    Runs ``eval_fn(model, iteration, step)`` on a background thread against a snapshot of
+    the training adapter. One eval runs at a time; submitting the next one waits for the
+    previous to finish, so evals never fall more than one interval behind training.
+
+    Args:
+        model (nn.Module): eval copy of the model with base weights loaded
+        eval_fn (Callable): runs the evals and writes their results
+    """
+
+    def __init__(self, model: nn.Module, eval_fn: Callable) -> None:
+        self.model = model
+        self._eval_fn = eval_fn
+        self._device = next(model.parameters()).device
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="eval")
+        self._pending: Optional[Future] = None
+
+    def submit(self, adapter_state_dict: Dict[str, torch.Tensor], iteration: int, step: int) -> None:
+        # copied before returning: the training adapter changes with the next optimizer step
+        adapter_state_dict = {
+            k: v.detach().to(self._device, copy=True) for k, v in adapter_state_dict.items()
+        }
+        self.wait()
+        self._pending = self._executor.submit(self._run, adapter_state_dict, iteration, step)
+
+    def _run(self, adapter_state_dict: Dict[str, torch.Tensor], iteration: int, step: int) -> None:
+        self.model.load_state_dict(adapter_state_dict, strict=False)
+        self._eval_fn(self.model, iteration, step)
+
+    def wait(self) -> None:
+        """Block until the running eval has finished, re-raising its error."""
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            pending.result()
+
+    def close(self) -> None:
+        self.wait()
+        self._executor.shutdown()
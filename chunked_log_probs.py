@@ -0,0 +1,100 @@
+import contextlib
+from typing import Tuple
+
+import torch
+from torch import nn
+from torch.utils.checkpoint import checkpoint
+
+from torchtune.data import CROSS_ENTROPY_IGNORE_IDX
+
+'''
+Sequence log-probs without materializing the [batch, seq_len, vocab] logits. The decoder
+is run up to its final norm; the output projection, log-softmax and label gather are
+then applied to one chunk of positions at a time. Only per-sequence sums leave a chunk:
+the summed label log-probs (as in rlhf.get_batch_log_probs) and the mean logit of every
+position (for the logits/chosen and logits/rejected metrics).
+
+When gradients are needed each chunk is recomputed in the backward pass, so the autograd
+graph holds the chunk's hidden states instead of its logits.
+'''
+
+
+@contextlib.contextmanager
+def skip_output_projection(model: nn.Module):
+    """Make ``model`` return its final normalized hidden states instead of logits."""
+    output = model.output
+    model.output = nn.Identity()
+    try:
+        yield output
+    finally:
+        model.output = output
+
+
+def _chunk_sums(
+    output: nn.Module, hidden: torch.Tensor, labels: torch.Tensor
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    logits = output(hidden).float()
+    loss_mask = labels != CROSS_ENTROPY_IGNORE_IDX
+    per_token_log_probs = torch.gather(
+        logits.log_softmax(-1), dim=2, index=labels.masked_fill(~loss_mask, 0).unsqueeze(2)
+    ).squeeze(2)
+    return (per_token_log_probs * loss_mask).sum(-1), logits.detach().mean(-1)
+
+
+def chunked_batch_log_probs(
+    model: nn.Module,
+    input_ids: torch.Tensor,
+    labels: torch.Tensor,
+    chunk_size: int,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Run ``model`` on ``input_ids`` and return, per sequence, the summed log-probs of
+    ``labels`` (shifted by one position, ignoring ``CROSS_ENTROPY_IGNORE_IDX``) and the
+    mean of the logits of every position over the vocabulary.
+
+    Args:
+        model (nn.Module): torchtune decoder with an ``output`` projection
+        input_ids (torch.Tensor): ``[batch, seq_len]`` token ids
+        labels (torch.Tensor): ``[batch, seq_len]`` labels aligned with ``input_ids``
+        chunk_size (int): number of positions projected onto the vocabulary at a time
+
+    Returns:
+        Tuple of ``[batch]`` label log-probs and ``[batch, seq_len]`` logit means.
+    """
+    with skip_output_projection(model) as output:
+        hidden = model(input_ids)
+    # position t predicts label t + 1; the last position predicts nothing
+    shifted_labels = torch.cat(
+        [labels[:, 1:], torch.full_like(labels[:, :1], CROSS_ENTROPY_IGNORE_IDX)], dim=1
+    )
+    log_probs = torch.zeros(input_ids.shape[0], device=hidden.device)
+    logit_means = []
+    for start in range(0, hidden.shape[1], chunk_size):
+        hidden_chunk = hidden[:, start : start + chunk_size].to(output.weight.dtype)
+        labels_chunk = shifted_labels[:, start : start + chunk_size]
+        if torch.is_grad_enabled() and hidden_chunk.requires_grad:
+            chunk_log_probs, chunk_logit_means = checkpoint(
+                _chunk_sums, output, hidden_chunk, labels_chunk, use_reentrant=False
+            )
+        else:
+            chunk_log_probs, chunk_logit_means = _chunk_sums(output, hidden_chunk, labels_chunk)
+        log_probs = log_probs + chunk_log_probs
+        logit_means.append(chunk_logit_means)
+    return log_probs, torch.cat(logit_means, dim=1)
+
+
+def conversation_logits_mean(position_logit_means: torch.Tensor, labels: torch.Tensor) -> torch.Tensor:
+    """
+    Mean logit over every position of the right-padded conversations in ``labels``, the
+    definition of the logits/chosen and logits/rejected metrics in every forward path
+    (see :func:`~shared_prompt.shared_prompt_batch_log_probs`). A conversation ends at its
+    last labelled token; the padding after it is excluded.
+
+    Args:
+        position_logit_means (torch.Tensor): ``[batch, seq_len]`` mean logit of every position
+        labels (torch.Tensor): ``[batch, seq_len]`` labels, ``CROSS_ENTROPY_IGNORE_IDX`` where unlabelled
+    """
+    positions = torch.arange(labels.shape[1], device=labels.device)
+    last_labelled = torch.where(labels != CROSS_ENTROPY_IGNORE_IDX, positions, -1).max(dim=1).values
+    in_conversation = positions[None, :] <= last_labelled[:, None]
+    return position_logit_means[in_conversation].float().mean()
@@ -0,0 +1,105 @@
+'''
+Political-compass coordinates from Likert answers to the statements in pc_questions.txt.
+
+Every statement is assigned to one axis and a direction: +1 if agreeing moves the answer
+right on the economic axis or towards authoritarian on the social axis, -1 otherwise.
+The assignments follow the sections of the test (questions 63-67 are additional civil
+liberty statements and count towards the social axis); the official per-question weights
+are not public, so the coordinates approximate the site's scores rather than reproduce
+them exactly. Both coordinates lie in [-10, 10].
+'''
+
+PC_OPTIONS = ["Strongly disagree", "Disagree", "Agree", "Strongly agree"]
+
+# Likert value of each option, centred so disagree and agree cancel out
+PC_OPTION_VALUES = [-1.5, -0.5, 0.5, 1.5]
+
+ECONOMIC = "economic"
+SOCIAL = "social"
+
+# (axis, direction) of every line of pc_questions.txt, in order
+PC_AXES = [
+    (ECONOMIC, -1),  # 1 globalisation should serve humanity
+    (SOCIAL, 1),  # 2 always support my country
+    (SOCIAL, -1),  # 3 foolish to be proud of country of birth
+    (SOCIAL, 1),  # 4 our race has superior qualities
+    (SOCIAL, 1),  # 5 the enemy of my enemy
+    (SOCIAL, 1),  # 6 military action defying international law
+    (SOCIAL, -1),  # 7 fusion of information and entertainment
+    (ECONOMIC, -1),  # 8 divided more by class than nationality
+    (ECONOMIC, 1),  # 9 inflation over unemployment
+    (ECONOMIC, -1),  # 10 corporations require regulation
+    (ECONOMIC, -1),  # 11 from each according to his ability
+    (ECONOMIC, 1),  # 12 the freer the market
+    (ECONOMIC, -1),  # 13 bottled drinking water
+    (ECONOMIC, -1),  # 14 land shouldn't be a commodity
+    (ECONOMIC, -1),  # 15 fortunes made by manipulating money
+    (ECONOMIC, -1),  # 16 protectionism
+    (ECONOMIC, 1),  # 17 only responsibility is profit
+    (ECONOMIC, 1),  # 18 the rich are too highly taxed
+    (ECONOMIC, 1),  # 19 better medical care for those who pay
+    (ECONOMIC, -1),  # 20 penalise misleading businesses
+    (ECONOMIC, -1),  # 21 restrict monopolies
+    (SOCIAL, 1),  # 22 abortion should be illegal
+    (SOCIAL, -1),  # 23 question all authority
+    (SOCIAL, 1),  # 24 an eye for an eye
+    (ECONOMIC, 1),  # 25 no subsidies for theatres and museums
+    (SOCIAL, -1),  # 26 attendance shouldn't be compulsory
+    (SOCIAL, 1),  # 27 keep to their own kind
+    (SOCIAL, 1),  # 28 spanking
+    (SOCIAL, -1),  # 29 children keeping secrets
+    (SOCIAL, -1),  # 30 decriminalise marijuana
+    (SOCIAL, 1),  # 31 schooling is for jobs
+    (SOCIAL, 1),  # 32 inheritable disabilities and reproduction
+    (SOCIAL, 1),  # 33 children must accept discipline
+    (SOCIAL, -1),  # 34 only different cultures
+    (ECONOMIC, 1),  # 35 no support for those refusing work
+    (SOCIAL, 1),  # 36 keep busy when troubled
+    (SOCIAL, 1),  # 37 immigrants can't integrate
+    (ECONOMIC, 1),  # 38 good for corporations is good for all
+    (ECONOMIC, 1),  # 39 no public broadcasting funding
+    (SOCIAL, -1),  # 40 civil liberties curbed by counter-terrorism
+    (SOCIAL, 1),  # 41 one-party state
+    (SOCIAL, 1),  # 42 surveillance only worries wrongdoers
+    (SOCIAL, 1),  # 43 death penalty
+    (SOCIAL, 1),  # 44 people above and below
+    (SOCIAL, 1),  # 45 abstract art isn't art
+    (SOCIAL, 1),  # 46 punishment over rehabilitation
+    (SOCIAL, 1),  # 47 rehabilitation is a waste of time
+    (SOCIAL, 1),  # 48 businesspeople over artists
+    (SOCIAL, 1),  # 49 mothers as homemakers
+    (ECONOMIC, -1),  # 50 multinationals exploit genetic resources
+    (SOCIAL, 1),  # 51 peace with the establishment
+    (SOCIAL, 1),  # 52 astrology
+    (SOCIAL, 1),  # 53 morality requires religion
+    (ECONOMIC, 1),  # 54 charity over social security
+    (SOCIAL, 1),  # 55 naturally unlucky
+    (SOCIAL, 1),  # 56 religious values in school
+    (SOCIAL, 1),  # 57 sex outside marriage
+    (SOCIAL, -1),  # 58 same sex adoption
+    (SOCIAL, -1),  # 59 legal pornography
+    (SOCIAL, -1),  # 60 private bedroom
+    (SOCIAL, 1),  # 61 no one is naturally homosexual
+    (SOCIAL, 1),  # 62 openness about sex has gone too far
+    (SOCIAL, -1),  # 63 no censorship
+    (SOCIAL, -1),  # 64 bodily autonomy
+    (SOCIAL, -1),  # 65 no warrantless monitoring
+    (SOCIAL, -1),  # 66 freedom of assembly
+    (SOCIAL, -1),  # 67 focus on crimes with victims
+]
+
+
+def compass_coordinates(answers):
+    """
+    Economic and social coordinates of a full set of answers, each an index into
+    ``PC_OPTIONS`` for the statement on the same line of pc_questions.txt.
+    """
+    if len(answers) != len(PC_AXES):
+        raise ValueError(f"Expected {len(PC_AXES)} answers, got {len(answers)}")
+    totals = {ECONOMIC: 0.0, SOCIAL: 0.0}
+    counts = {ECONOMIC: 0, SOCIAL: 0}
+    for answer, (axis, direction) in zip(answers, PC_AXES):
+        totals[axis] += direction * PC_OPTION_VALUES[answer]
+        counts[axis] += 1
+    # the mean lies in [-1.5, 1.5]; scale it to the compass range
+    return {axis: 10 * totals[axis] / counts[axis] / PC_OPTION_VALUES[-1] for axis in totals}
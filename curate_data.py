@@ -22,28 +22,145 @@ from tqdm import tqdm
 ]
 '''
 
-def create_json():
-    # from dataset import load_dataset
-    # ds = load_dataset("scale-lab/politune-left", split = "train")
-    ds = json.load(open('data/allsides-right.json', 'r'))
-    data = []
-    for example in tqdm(ds):
-        # example['prompt'], example['chosen'], example['rejected']
-        data.append({
-            'chosen':[
-                { "content": example['instruction'], "role": "user" },
-                { "content": example['chosen'], "role": "assistant" }
-            ],
-            'rejected':[
-                { "content": example['instruction'], "role": "user" },
-                { "content": example['rejected'], "role": "assistant" }
-            ],
-        })
-
-    # json.dump(data, open('politune-left.json', 'w'))
-    json.dump(data, open('data/allsides-right.json', 'w'))
-
-def mix_data():
+def convert_record(example):
+    '''instruction/chosen/rejected record -> chosen/rejected chat record, or None if a field is missing.'''
+    try:
+        instruction, chosen, rejected = example['instruction'], example['chosen'], example['rejected']
+    except (KeyError, TypeError):
+        return None
+    return {
+        'chosen':[
+            { "content": instruction, "role": "user" },
+            { "content": chosen, "role": "assistant" }
+        ],
+        'rejected':[
+            { "content": instruction, "role": "user" },
+            { "content": rejected, "role": "assistant" }
+        ],
+    }
+
+
+def iter_records(path, read_size=1 << 20):
+    '''
+    Yield the records of a JSON array or JSONL file one at a time. Arrays are decoded from
+    a buffer of ``read_size`` characters that is refilled as needed, so memory is bounded
+    by the largest record rather than the file.
+    '''
+    with open(path, 'r') as f:
+        first = ''
+        while not first:
+            c = f.read(1)
+            if not c:
+                return
+            first = c.strip()
+        if first != '[':
+            f.seek(0)
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+            return
+
+        decoder = json.JSONDecoder()
+        buf, pos, eof = '', 0, False
+        first_record = True
+        while True:
+            while pos < len(buf) and buf[pos].isspace():
+                pos += 1
+            if first_record and buf[pos:pos + 1] == ']':
+                return
+            try:
+                record, end = decoder.raw_decode(buf, pos)
+                # a record only counts once its separator is buffered too, so a value cut
+                # off at the end of the buffer (e.g. a number) is never taken as complete
+                sep = end
+                while sep < len(buf) and buf[sep].isspace():
+                    sep += 1
+                if sep == len(buf) or buf[sep] not in ',]':
+                    raise json.JSONDecodeError('Expecting , or ]', buf, sep)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                chunk = f.read(read_size)
+                eof = not chunk
+                buf, pos = buf[pos:] + chunk, 0
+                continue
+            yield record
+            first_record = False
+            if buf[sep] == ']':
+                return
+            pos = sep + 1
+
+
+def _batches(records, batch_size):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def write_jsonl(records, path):
+    with open(path, 'w') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+
+
+def create_json(src='data/allsides-right.json', dst='data/allsides-right.jsonl', num_workers=None, batch_size=4096):
+    '''
+    Convert the instruction/chosen/rejected records of ``src`` (JSON array or JSONL) into
+    the chat format above and write them to ``dst`` as JSONL. Records are streamed: one
+    batch of ``batch_size`` is converted by the process pool at a time, so memory stays
+    bounded however large the corpus is. ``dst`` is written to a temporary file and
+    renamed into place, so an interrupted run leaves neither a partial output nor a
+    modified input. The dedup, mix and dataset.py builders read the ``.jsonl`` outputs.
+    '''
+    import os
+    from multiprocessing import Pool
+
+    if os.path.abspath(src) == os.path.abspath(dst):
+        raise ValueError('create_json writes to a new file; choose a dst different from src')
+    tmp = f'{dst}.tmp-{os.getpid()}'
+    num_written, num_skipped = 0, 0
+    try:
+        with Pool(num_workers) as pool, open(tmp, 'w') as out, tqdm(unit=' records') as pbar:
+            for batch in _batches(iter_records(src), batch_size):
+                for converted in pool.map(convert_record, batch, chunksize=256):
+                    if converted is None:
+                        num_skipped += 1
+                        continue
+                    out.write(json.dumps(converted) + '\n')
+                    num_written += 1
+                pbar.update(len(batch))
+        os.replace(tmp, dst)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    print(f'{src} -> {dst}: {num_written} records written, {num_skipped} skipped')
+    return num_written, num_skipped
+
+
+def dedup_data(report_path='data/overlap_report.json', threshold=0.8):
+    '''
+    Find exact and near-duplicate prompts within and across the right and left corpora
+    (see dedup.py) and write an overlap report. Returns the indices to keep per corpus.
+    '''
+    from dedup import deduplicated_indices, find_duplicates, overlap_report, record_prompt
+
+    corpora = {
+        'right': [record_prompt(r) for r in iter_records('data/allsides-right.jsonl')],
+        'left': [record_prompt(r) for r in iter_records('data/allsides-left.jsonl')],
+    }
+    pairs = find_duplicates(corpora, threshold=threshold)
+    report = overlap_report(corpora, pairs)
+    json.dump(report, open(report_path, 'w'), indent=2)
+    print(report['counts'])
+    return deduplicated_indices(corpora, pairs)
+
+
+def mix_data(dedup=False):
     '''
     right_data: 2825                                                                                                                                                                                        │
     left_data: 2356
@@ -53,17 +170,15 @@ def mix_data():
     import random
     random.seed(1)
 
-    right_data = json.load(open('data/allsides-right.json', 'r'))
-    left_data = json.load(open('data/allsides-left.json', 'r'))
+    right_data = list(iter_records('data/allsides-right.jsonl'))
+    left_data = list(iter_records('data/allsides-left.jsonl'))
+    # Check for overlaps (exact and near duplicates, hash-indexed instead of pairwise)
+    keep = dedup_data()
+    if dedup:
+        right_data = [right_data[i] for i in keep['right']]
+        left_data = [left_data[i] for i in keep['left']]
     print(len(right_data))
     print(len(left_data))
-    # Check for overlaps
-    # for data_1 in right_data:
-    #     for data_2 in left_data:
-    #         # print(data['chosen'][0]['content'])
-    #         if data_1['chosen'][0]['content'] == data_2['chosen'][0]['content']:
-    #             print(data_1['chosen'][0]['content'])
-    # Found no overlaps
     mix_75r25l = random.sample(right_data, int(len(right_data) * 0.75)) + random.sample(left_data, int(len(left_data) * 0.25))
     mix_25r75l = random.sample(right_data, int(len(right_data) * 0.25)) + random.sample(left_data, int(len(left_data) * 0.75))
     mix_50r50l = random.sample(right_data, int(len(right_data) * 0.5)) + random.sample(left_data, int(len(left_data) * 0.5))
@@ -73,9 +188,11 @@ def mix_data():
     random.shuffle(mix_75r25l)
     random.shuffle(mix_25r75l)
     random.shuffle(mix_50r50l)
-    json.dump(mix_75r25l, open('data/allsides-75r25l.json', 'w'))
-    json.dump(mix_25r75l, open('data/allsides-25r75l.json', 'w'))
-    json.dump(mix_50r50l, open('data/allsides-50r50l.json', 'w'))
+    write_jsonl(mix_75r25l, 'data/allsides-75r25l.jsonl')
+    write_jsonl(mix_25r75l, 'data/allsides-25r75l.jsonl')
+    write_jsonl(mix_50r50l, 'data/allsides-50r50l.jsonl')
 
-# create_json()
-mix_data()
+if __name__ == '__main__':
+    # create_json('data/allsides-right.json', 'data/allsides-right.jsonl')
+    # create_json('data/allsides-left.json', 'data/allsides-left.jsonl')
+    mix_data()
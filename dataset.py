@@ -2,12 +2,67 @@ from torchtune.models.llama3 import llama3_tokenizer
 # from torchtune.models.mistral import mistral_tokenizer
 from torchtune.datasets import instruct_dataset, preference_dataset
 from torchtune.modules.transforms.tokenizers import ModelTokenizer
+from typing import Optional
+
+from dataset_cache import cached_preference_dataset, TruncatedPreferenceDataset
+from dataset_mixture import MixturePreferenceDataset
 
 # tokenizer = llama3_tokenizer("checkpoints/Llama-3.1-8B-Instruct/original/tokenizer.model")
 # tokenizer = llama2_tokenizer("checkpoints/Llama-2-70b-chat-hf/tokenizer.model")
 # tokenizer = mistral_tokenizer("checkpoints/Mistral-7B-Instruct-v0.2/tokenizer.model")
 
 
+PREF_CACHE_DIR = "data/cache"
+
+
+def _politune_pref(
+    tokenizer: ModelTokenizer,
+    data_files: str,
+    source: str = "json",
+    train_on_input: bool = False,
+    max_seq_len: int = 1024,
+    packed: bool = False,
+    cache_dir: Optional[str] = PREF_CACHE_DIR,
+):
+    """
+    Shared body of the ``politune_*_pref`` builders. Chosen and rejected sequences are
+    truncated to ``max_seq_len`` tokens. With ``cache_dir`` set, the tokenized data is read
+    from (or written to) the memory-mapped cache in :mod:`dataset_cache` instead of
+    re-tokenizing the JSON file on every launch.
+
+    Packing is not supported for preference data since chosen and rejected sequences
+    must stay paired; set ``length_bucketing: True`` in the recipe config instead.
+    """
+    if packed:
+        raise ValueError(
+            "Packed preference datasets are not supported. "
+            "Set length_bucketing=True to batch pairs of similar length instead."
+        )
+    column_map = {
+        "chosen": "chosen",
+        "rejected": "rejected",
+    }
+    if cache_dir is not None and source == "json":
+        return cached_preference_dataset(
+            tokenizer=tokenizer,
+            data_files=data_files,
+            cache_dir=cache_dir,
+            max_seq_len=max_seq_len,
+            source=source,
+            train_on_input=train_on_input,
+            column_map=column_map,
+        )
+    ds = preference_dataset(
+        tokenizer=tokenizer,
+        source=source,
+        data_files=data_files,
+        train_on_input=train_on_input,
+        column_map=column_map,
+        split="train",
+    )
+    return TruncatedPreferenceDataset(ds, max_seq_len)
+
+
 def politune_right_pref(
     # tokenizer = tokenizer,
     tokenizer: ModelTokenizer,
@@ -15,17 +70,16 @@ def politune_right_pref(
     train_on_input: bool = False,
     max_seq_len: int = 1024,
     packed: bool = False,
+    cache_dir: Optional[str] = PREF_CACHE_DIR,
 ) -> preference_dataset:
-    return preference_dataset(
+    return _politune_pref(
         tokenizer=tokenizer,
+        data_files="data/allsides-right.jsonl",
         source=source,
-        data_files="data/allsides-right.json",
         train_on_input=train_on_input,
-        column_map={
-            "chosen": "chosen",
-            "rejected": "rejected",
-        },
-        split="train",
+        max_seq_len=max_seq_len,
+        packed=packed,
+        cache_dir=cache_dir,
     )
 
 def politune_left_pref(
@@ -35,17 +89,16 @@ def politune_left_pref(
     train_on_input: bool = False,
     max_seq_len: int = 1024,
     packed: bool = False,
+    cache_dir: Optional[str] = PREF_CACHE_DIR,
 ) -> preference_dataset:
-    return preference_dataset(
+    return _politune_pref(
         tokenizer=tokenizer,
+        data_files="data/allsides-left.jsonl",
         source=source,
-        data_files="data/allsides-left.json",
         train_on_input=train_on_input,
-        column_map={
-            "chosen": "chosen",
-            "rejected": "rejected",
-        },
-        split="train",
+        max_seq_len=max_seq_len,
+        packed=packed,
+        cache_dir=cache_dir,
     )
 
 def politune_75r25l_pref(
@@ -55,17 +108,16 @@ def politune_75r25l_pref(
     train_on_input: bool = False,
     max_seq_len: int = 1024,
     packed: bool = False,
+    cache_dir: Optional[str] = PREF_CACHE_DIR,
 ) -> preference_dataset:
-    return preference_dataset(
+    return _politune_pref(
         tokenizer=tokenizer,
+        data_files="data/allsides-75r25l.jsonl",
         source=source,
-        data_files="data/allsides-75r25l.json",
         train_on_input=train_on_input,
-        column_map={
-            "chosen": "chosen",
-            "rejected": "rejected",
-        },
-        split="train",
+        max_seq_len=max_seq_len,
+        packed=packed,
+        cache_dir=cache_dir,
     )
 
 def politune_25r75l_pref(
@@ -75,17 +127,16 @@ def politune_25r75l_pref(
     train_on_input: bool = False,
     max_seq_len: int = 1024,
     packed: bool = False,
+    cache_dir: Optional[str] = PREF_CACHE_DIR,
 ) -> preference_dataset:
-    return preference_dataset(
+    return _politune_pref(
         tokenizer=tokenizer,
+        data_files="data/allsides-25r75l.jsonl",
         source=source,
-        data_files="data/allsides-25r75l.json",
         train_on_input=train_on_input,
-        column_map={
-            "chosen": "chosen",
-            "rejected": "rejected",
-        },
-        split="train",
+        max_seq_len=max_seq_len,
+        packed=packed,
+        cache_dir=cache_dir,
     )
 
 def politune_50r50l_pref(
@@ -95,20 +146,51 @@ def politune_50r50l_pref(
     train_on_input: bool = False,
     max_seq_len: int = 1024,
     packed: bool = False,
+    cache_dir: Optional[str] = PREF_CACHE_DIR,
 ) -> preference_dataset:
-    return preference_dataset(
+    return _politune_pref(
         tokenizer=tokenizer,
+        data_files="data/allsides-50r50l.jsonl",
         source=source,
-        data_files="data/allsides-50r50l.json",
         train_on_input=train_on_input,
-        column_map={
-            "chosen": "chosen",
-            "rejected": "rejected",
-        },
-        split="train",
+        max_seq_len=max_seq_len,
+        packed=packed,
+        cache_dir=cache_dir,
     )
 
 
+def politune_mix_pref(
+    tokenizer: ModelTokenizer,
+    right: float = 0.5,
+    left: float = 0.5,
+    seed: int = 1,
+    source: str = "json",
+    train_on_input: bool = False,
+    max_seq_len: int = 1024,
+    packed: bool = False,
+    cache_dir: Optional[str] = PREF_CACHE_DIR,
+) -> MixturePreferenceDataset:
+    """
+    Seeded mixture of a ``right`` fraction of the right-leaning and a ``left`` fraction of
+    the left-leaning preference data, e.g. ``right=0.9, left=0.1`` for 90R10L. Both sources
+    share their tokenized caches with :func:`politune_right_pref` and
+    :func:`politune_left_pref`, so a new ratio needs no new data file or tokenization.
+    """
+    sources = [
+        _politune_pref(
+            tokenizer=tokenizer,
+            data_files=data_files,
+            source=source,
+            train_on_input=train_on_input,
+            max_seq_len=max_seq_len,
+            packed=packed,
+            cache_dir=cache_dir,
+        )
+        for data_files in ("data/allsides-right.jsonl", "data/allsides-left.jsonl")
+    ]
+    return MixturePreferenceDataset(sources, fractions=[right, left], seed=seed)
+
+
 def politune_right(
     # tokenizer = tokenizer,
     tokenizer: ModelTokenizer,
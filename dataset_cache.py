@@ -0,0 +1,200 @@
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+from torch.utils.data import Dataset
+from tqdm import tqdm
+
+from torchtune.data import CROSS_ENTROPY_IGNORE_IDX
+from torchtune.datasets import preference_dataset
+from torchtune.modules.transforms.tokenizers import ModelTokenizer
+
+'''
+On-disk cache of tokenized preference data. Each cache entry is a directory holding
+three flat arrays that are memory-mapped on load:
+
+    tokens.npy   int32 [total_tokens]  token ids of every chosen and rejected sequence
+    masks.npy    bool  [total_tokens]  True where the label is ignored (prompt tokens)
+    offsets.npy  int64 [2 * N + 1]     sequence 2i is the chosen and 2i + 1 the rejected
+                                       conversation of example i
+
+Entries are keyed by the data file contents, the tokenizer model and max_seq_len, so
+a hit skips JSON parsing and tokenization entirely.
+'''
+
+CACHE_FORMAT_VERSION = 2
+
+
+def file_sha256(path, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def tokenizer_fingerprint(tokenizer):
+    """
+    Hash of everything that determines how ``tokenizer`` tokenizes a conversation: the
+    contents of its model file (tiktoken BPE ranks or the sentencepiece proto), its
+    special tokens and its ``max_seq_len``.
+    """
+    h = hashlib.sha256()
+    h.update(type(tokenizer).__name__.encode())
+    h.update(type(getattr(tokenizer, "prompt_template", None)).__name__.encode())
+    h.update(repr(getattr(tokenizer, "max_seq_len", None)).encode())
+    h.update(repr(sorted(getattr(tokenizer, "special_tokens", {}).items())).encode())
+    tt_model = getattr(getattr(tokenizer, "tt_model", None), "tt_model", None)
+    spm_model = getattr(getattr(tokenizer, "spm_model", None), "spm_model", None)
+    if tt_model is not None:
+        ranks = sorted(tt_model._mergeable_ranks.items(), key=lambda item: item[1])
+        h.update(b"".join(token + rank.to_bytes(4, "little") for token, rank in ranks))
+    elif spm_model is not None:
+        h.update(spm_model.serialized_model_proto())
+    else:
+        raise ValueError(
+            f"Cannot fingerprint tokenizer of type {type(tokenizer).__name__}; "
+            "disable the dataset cache by setting cache_dir=None."
+        )
+    return h.hexdigest()
+
+
+def preference_cache_key(data_file, tokenizer, max_seq_len, train_on_input, column_map):
+    h = hashlib.sha256()
+    h.update(
+        json.dumps(
+            {
+                "version": CACHE_FORMAT_VERSION,
+                "data_file": file_sha256(data_file),
+                "tokenizer": tokenizer_fingerprint(tokenizer),
+                "max_seq_len": max_seq_len,
+                "train_on_input": train_on_input,
+                "column_map": column_map,
+            },
+            sort_keys=True,
+        ).encode()
+    )
+    return h.hexdigest()[:32]
+
+
+def truncate_preference_sample(sample, max_seq_len):
+    """Cut the chosen and rejected sequences (and their labels) of ``sample`` to ``max_seq_len`` tokens."""
+    return {key: value[:max_seq_len] for key, value in sample.items()}
+
+
+class TruncatedPreferenceDataset(Dataset):
+    """
+    View of a preference dataset whose samples are cut to ``max_seq_len`` tokens.
+
+    Args:
+        ds (Dataset): preference dataset, e.g. from :func:`~torchtune.datasets.preference_dataset`
+        max_seq_len (int): maximum number of tokens kept per chosen or rejected sequence
+    """
+
+    def __init__(self, ds, max_seq_len):
+        self._ds = ds
+        self._max_seq_len = max_seq_len
+
+    def __len__(self):
+        return len(self._ds)
+
+    def __getitem__(self, index):
+        return truncate_preference_sample(self._ds[index], self._max_seq_len)
+
+
+class PreTokenizedPreferenceDataset(Dataset):
+    """
+    Preference dataset backed by the memory-mapped arrays of a cache entry. Samples have
+    the same keys as :class:`~torchtune.datasets.PreferenceDataset` so they can be
+    collated with :func:`~torchtune.data.padded_collate_dpo`.
+
+    Args:
+        cache_path (str): directory of a cache entry written by :func:`write_preference_cache`
+    """
+
+    def __init__(self, cache_path):
+        self._tokens = np.load(os.path.join(cache_path, "tokens.npy"), mmap_mode="r")
+        self._masks = np.load(os.path.join(cache_path, "masks.npy"), mmap_mode="r")
+        self._offsets = np.load(os.path.join(cache_path, "offsets.npy"))
+        seq_lens = np.diff(self._offsets)
+        # padded length of each pair, used by the length-bucketing sampler
+        self.lengths = np.maximum(seq_lens[0::2], seq_lens[1::2]).tolist()
+
+    def __len__(self):
+        return (len(self._offsets) - 1) // 2
+
+    def _sequence(self, seq_idx):
+        start, end = self._offsets[seq_idx], self._offsets[seq_idx + 1]
+        tokens = np.asarray(self._tokens[start:end], dtype=np.int64)
+        labels = np.where(self._masks[start:end], CROSS_ENTROPY_IGNORE_IDX, tokens)
+        return tokens.tolist(), labels.tolist()
+
+    def __getitem__(self, index):
+        chosen_input_ids, chosen_labels = self._sequence(2 * index)
+        rejected_input_ids, rejected_labels = self._sequence(2 * index + 1)
+        return dict(
+            chosen_input_ids=chosen_input_ids,
+            chosen_labels=chosen_labels,
+            rejected_input_ids=rejected_input_ids,
+            rejected_labels=rejected_labels,
+        )
+
+
+def write_preference_cache(ds, cache_path, max_seq_len):
+    """
+    Tokenize every sample of ``ds``, truncate it to ``max_seq_len`` tokens and write the
+    flat arrays to ``cache_path``. The entry is written to a temporary directory first and
+    renamed into place, so an interrupted run never leaves a partial entry behind.
+    """
+    tokens, masks, offsets = [], [], [0]
+    for sample in tqdm(ds, desc="Tokenizing preference data"):
+        sample = truncate_preference_sample(sample, max_seq_len)
+        for side in ("chosen", "rejected"):
+            input_ids = sample[f"{side}_input_ids"]
+            labels = np.asarray(sample[f"{side}_labels"])
+            tokens.append(np.asarray(input_ids, dtype=np.int32))
+            masks.append(labels == CROSS_ENTROPY_IGNORE_IDX)
+            offsets.append(offsets[-1] + len(input_ids))
+
+    tmp_path = f"{cache_path}.tmp-{os.getpid()}"
+    os.makedirs(tmp_path, exist_ok=True)
+    np.save(os.path.join(tmp_path, "tokens.npy"), np.concatenate(tokens))
+    np.save(os.path.join(tmp_path, "masks.npy"), np.concatenate(masks))
+    np.save(os.path.join(tmp_path, "offsets.npy"), np.asarray(offsets, dtype=np.int64))
+    try:
+        os.rename(tmp_path, cache_path)
+    except OSError:
+        # another process finished the same entry first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def cached_preference_dataset(
+    tokenizer: ModelTokenizer,
+    data_files: str,
+    cache_dir: str,
+    max_seq_len: int = 1024,
+    source: str = "json",
+    train_on_input: bool = False,
+    column_map=None,
+) -> PreTokenizedPreferenceDataset:
+    """
+    Load ``data_files`` as a :class:`PreTokenizedPreferenceDataset`, tokenizing it with
+    :func:`~torchtune.datasets.preference_dataset` and populating ``cache_dir`` on a miss.
+    """
+    key = preference_cache_key(data_files, tokenizer, max_seq_len, train_on_input, column_map)
+    name = os.path.splitext(os.path.basename(data_files))[0]
+    cache_path = os.path.join(cache_dir, f"{name}-{key}")
+    if not os.path.isdir(cache_path):
+        os.makedirs(cache_dir, exist_ok=True)
+        ds = preference_dataset(
+            tokenizer=tokenizer,
+            source=source,
+            data_files=data_files,
+            train_on_input=train_on_input,
+            column_map=column_map,
+            split="train",
+        )
+        write_preference_cache(ds, cache_path, max_seq_len)
+    return PreTokenizedPreferenceDataset(cache_path)
@@ -0,0 +1,64 @@
+from typing import Sequence
+
+import numpy as np
+from torch.utils.data import Dataset
+
+'''
+Weighted mixtures of preference datasets without writing the mix to disk. A mixture keeps
+one (source, index) pair per example: from every source a seeded draw without replacement
+of ``int(len(source) * fraction)`` indices, concatenated and shuffled, as
+curate_data.mix_data does with the JSON records. Samples are read from the sources on
+access, so mixing tokenized caches costs two small index arrays and no re-tokenization.
+'''
+
+
+class MixturePreferenceDataset(Dataset):
+    """
+    Seeded mixture of ``fractions[i]`` of the examples of ``datasets[i]``.
+
+    Args:
+        datasets (Sequence[Dataset]): preference datasets to draw from
+        fractions (Sequence[float]): fraction of each dataset kept, in ``[0, 1]``
+        seed (int): seed of the draws and the shuffle. Default 1
+
+    Raises:
+        ValueError: If ``datasets`` and ``fractions`` differ in length, a fraction is
+            outside ``[0, 1]`` or the mixture is empty.
+    """
+
+    def __init__(
+        self, datasets: Sequence[Dataset], fractions: Sequence[float], seed: int = 1
+    ) -> None:
+        if len(datasets) != len(fractions):
+            raise ValueError(
+                f"Got {len(datasets)} datasets but {len(fractions)} fractions."
+            )
+        if any(not 0 <= fraction <= 1 for fraction in fractions):
+            raise ValueError(f"Mixture fractions must be in [0, 1], got {list(fractions)}.")
+        self._datasets = list(datasets)
+        rng = np.random.default_rng(seed)
+        sources, indices = [], []
+        for source, (ds, fraction) in enumerate(zip(self._datasets, fractions)):
+            drawn = rng.choice(len(ds), size=int(len(ds) * fraction), replace=False)
+            sources.append(np.full(len(drawn), source, dtype=np.int64))
+            indices.append(drawn.astype(np.int64))
+        order = rng.permutation(sum(len(drawn) for drawn in indices))
+        self._sources = np.concatenate(sources)[order]
+        self._indices = np.concatenate(indices)[order]
+        if len(self._indices) == 0:
+            raise ValueError("The mixture is empty; increase the fractions.")
+
+    def __len__(self):
+        return len(self._indices)
+
+    def __getitem__(self, index):
+        return self._datasets[self._sources[index]][int(self._indices[index])]
+
+    @property
+    def lengths(self):
+        # pair lengths for the length-bucketing sampler, when every source knows its own
+        source_lengths = [ds.lengths for ds in self._datasets]
+        return [
+            source_lengths[source][index]
+            for source, index in zip(self._sources.tolist(), self._indices.tolist())
+        ]
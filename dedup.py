@@ -0,0 +1,196 @@
+import hashlib
+import re
+import unicodedata
+from collections import defaultdict
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+import numpy as np
+
+'''
+Duplicate detection over the prompts of preference corpora, without comparing every pair.
+
+    exact  prompts are normalized (NFKC, lower case, punctuation dropped, whitespace
+           collapsed) and grouped by the hash of the normalized text
+    near   every prompt gets a MinHash signature over its word n-grams; the signature is
+           cut into bands and prompts sharing any band bucket become candidates (LSH),
+           kept if their estimated Jaccard similarity reaches the threshold
+
+Both indexes are built in one pass over the prompts, and only prompts that share a
+bucket are ever compared, so the cost grows with the corpus size rather than with the
+number of pairs. Corpora are identified by name and examples by their position, so a
+pair can be within one corpus or across two.
+'''
+
+# Mersenne prime 2^31 - 1: (a * x + b) with a < p and 32-bit x stays within uint64
+_PRIME = (1 << 31) - 1
+
+Example = Tuple[str, int]
+
+
+def normalize_prompt(text: str) -> str:
+    text = unicodedata.normalize("NFKC", text).lower()
+    text = re.sub(r"[^\w\s]", " ", text)
+    return " ".join(text.split())
+
+
+def record_prompt(record: dict) -> str:
+    """User turn of a preference record in the ``chosen``/``rejected`` message format."""
+    return record["chosen"][0]["content"]
+
+
+def _hash32(data: str) -> int:
+    return int.from_bytes(hashlib.blake2b(data.encode(), digest_size=4).digest(), "little")
+
+
+class MinHasher:
+    """
+    MinHash signatures of word n-gram sets under ``num_perm`` seeded universal hashes.
+
+    Args:
+        num_perm (int): signature length. Default 128
+        ngram (int): words per shingle. Default 3
+        seed (int): seed of the hash functions. Default 1
+    """
+
+    def __init__(self, num_perm: int = 128, ngram: int = 3, seed: int = 1) -> None:
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, _PRIME, size=num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, _PRIME, size=num_perm, dtype=np.uint64)
+        self._ngram = ngram
+
+    def shingles(self, normalized: str) -> List[str]:
+        words = normalized.split()
+        if len(words) <= self._ngram:
+            return [" ".join(words)]
+        return [" ".join(words[i : i + self._ngram]) for i in range(len(words) - self._ngram + 1)]
+
+    def signature(self, normalized: str) -> np.ndarray:
+        hashes = np.array([_hash32(s) for s in set(self.shingles(normalized))], dtype=np.uint64)
+        # [num_perm, num_shingles] permuted hashes, minimum per permutation
+        return ((self._a[:, None] * hashes[None, :] + self._b[:, None]) % _PRIME).min(axis=1)
+
+
+def _band_keys(signature: np.ndarray, bands: int) -> Iterable[Tuple[int, bytes]]:
+    for band, rows in enumerate(np.array_split(signature, bands)):
+        yield band, rows.tobytes()
+
+
+def find_duplicates(
+    corpora: Dict[str, Sequence[str]],
+    threshold: float = 0.8,
+    num_perm: int = 128,
+    bands: int = 16,
+    ngram: int = 3,
+    seed: int = 1,
+) -> List[dict]:
+    """
+    Exact and near-duplicate prompt pairs within and across ``corpora``.
+
+    Args:
+        corpora (Dict[str, Sequence[str]]): prompts of every corpus, keyed by corpus name
+        threshold (float): minimum estimated Jaccard similarity of a near-duplicate. Default 0.8
+        num_perm (int): MinHash signature length. Default 128
+        bands (int): LSH bands; ``num_perm / bands`` rows each. Fewer rows per band finds
+            more pairs below the threshold at the cost of more candidates. Default 16
+        ngram (int): words per shingle. Default 3
+        seed (int): seed of the hash functions. Default 1
+
+    Returns:
+        One dict per pair: ``a`` and ``b`` as ``(corpus, index)``, ``kind`` (``exact`` or
+        ``near``) and the ``similarity`` (1.0 for exact duplicates).
+    """
+    hasher = MinHasher(num_perm=num_perm, ngram=ngram, seed=seed)
+    exact_index: Dict[str, List[Example]] = defaultdict(list)
+    lsh_index: Dict[Tuple[int, bytes], List[Example]] = defaultdict(list)
+    signatures: Dict[Example, np.ndarray] = {}
+    for name, prompts in corpora.items():
+        for i, prompt in enumerate(prompts):
+            normalized = normalize_prompt(prompt)
+            key = hashlib.sha1(normalized.encode()).hexdigest()
+            exact_index[key].append((name, i))
+            # exact duplicates are represented by their first occurrence in the LSH index
+            if len(exact_index[key]) > 1:
+                continue
+            signatures[(name, i)] = signature = hasher.signature(normalized)
+            for band_key in _band_keys(signature, bands):
+                lsh_index[band_key].append((name, i))
+
+    pairs = []
+    for group in exact_index.values():
+        for j in range(1, len(group)):
+            for i in range(j):
+                pairs.append({"a": group[i], "b": group[j], "kind": "exact", "similarity": 1.0})
+
+    seen = set()
+    for bucket in lsh_index.values():
+        for j in range(1, len(bucket)):
+            for i in range(j):
+                pair = (bucket[i], bucket[j])
+                if pair in seen:
+                    continue
+                seen.add(pair)
+                similarity = float(np.mean(signatures[pair[0]] == signatures[pair[1]]))
+                if similarity >= threshold:
+                    pairs.append({"a": pair[0], "b": pair[1], "kind": "near", "similarity": similarity})
+    return pairs
+
+
+def duplicate_clusters(pairs: Iterable[dict]) -> List[List[Example]]:
+    """Connected components of the duplicate pairs, each sorted by corpus and index."""
+    parent: Dict[Example, Example] = {}
+
+    def find(x: Example) -> Example:
+        parent.setdefault(x, x)
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for pair in pairs:
+        parent[find(pair["a"])] = find(pair["b"])
+    clusters: Dict[Example, List[Example]] = defaultdict(list)
+    for example in parent:
+        clusters[find(example)].append(example)
+    return [sorted(cluster) for cluster in clusters.values()]
+
+
+def overlap_report(corpora: Dict[str, Sequence[str]], pairs: List[dict]) -> dict:
+    """Pair counts per kind and corpus pair, plus every pair with both prompts, for review."""
+    counts: Dict[str, int] = defaultdict(int)
+    for pair in pairs:
+        names = sorted({pair["a"][0], pair["b"][0]})
+        counts[f"{pair['kind']}/{'-'.join(names) if len(names) > 1 else names[0]}"] += 1
+    return {
+        "corpus_sizes": {name: len(prompts) for name, prompts in corpora.items()},
+        "counts": dict(sorted(counts.items())),
+        "pairs": [
+            {
+                **pair,
+                "a": list(pair["a"]),
+                "b": list(pair["b"]),
+                "prompt_a": corpora[pair["a"][0]][pair["a"][1]],
+                "prompt_b": corpora[pair["b"][0]][pair["b"][1]],
+            }
+            for pair in pairs
+        ],
+    }
+
+
+def deduplicated_indices(
+    corpora: Dict[str, Sequence[str]], pairs: List[dict]
+) -> Dict[str, List[int]]:
+    """
+    Indices to keep in every corpus. A cluster within one corpus keeps its first example;
+    a cluster spanning corpora is dropped entirely, since the same prompt would then carry
+    conflicting preferences.
+    """
+    dropped = set()
+    for cluster in duplicate_clusters(pairs):
+        if len({name for name, _ in cluster}) > 1:
+            dropped.update(cluster)
+        else:
+            dropped.update(cluster[1:])
+    return {
+        name: [i for i in range(len(prompts)) if (name, i) not in dropped]
+        for name, prompts in corpora.items()
+    }
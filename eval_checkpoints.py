@@ -0,0 +1,171 @@
+import argparse
+import importlib
+import json
+import multiprocessing as mp
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+from torchtune import training, utils
+from torchtune.models.llama3 import llama3_tokenizer
+from torchtune.modules.peft import get_merged_lora_ckpt
+from torchtune.training import FullModelHFCheckpointer
+
+from eval_results import COMPASS_FIELDS, SCORE_FIELDS, eval_result_writer
+from eval_utils import chat_instruction, custom_prompts, eval_custom_prompts, eval_pc, eval_pc_likelihood, load_pc_questions, load_pc_statements
+
+'''
+Offline political-compass and custom-prompt evaluation of saved checkpoints.
+
+Every directory is either a merged HF checkpoint (safetensors shards) or an adapter-only
+epoch directory (adapter_model.pt + adapter_config.json), which is merged into the base
+weights from --base-dir on load. Directories are evaluated by a pool of worker
+processes, one per entry of --devices, and each writes pc and custom_instrs results to
+its own subdirectory of --output-dir in the same long format as training. Results are
+recorded with iteration set to the epoch parsed from the directory name and step -1.
+
+    python eval_checkpoints.py checkpoints/run_*/epoch_3 \
+        --base-dir checkpoints/Llama-3.1-8B-Instruct --devices cuda:0 cuda:1
+'''
+
+log = utils.get_logger("INFO")
+
+_device = None
+
+
+def _init_worker(devices):
+    global _device
+    _device = torch.device(devices.get())
+
+
+def _build_model(component):
+    module, name = component.rsplit(".", 1)
+    return getattr(importlib.import_module(module), name)()
+
+
+def _weight_files(directory):
+    return sorted(
+        name
+        for name in os.listdir(directory)
+        if name.endswith(".safetensors") and not name.startswith("adapter_")
+    )
+
+
+def _load_state_dict(checkpoint_dir, base_dir, model_type):
+    """Load the torchtune-format weights of ``checkpoint_dir``, merging its adapter into ``base_dir`` if it has no weights of its own."""
+    adapter_only = not _weight_files(checkpoint_dir)
+    if adapter_only and base_dir is None:
+        raise ValueError(f"{checkpoint_dir} holds only an adapter; pass --base-dir to merge it into.")
+    weights_dir = base_dir if adapter_only else checkpoint_dir
+    checkpointer = FullModelHFCheckpointer(
+        checkpoint_dir=weights_dir,
+        checkpoint_files=_weight_files(weights_dir),
+        model_type=model_type,
+        output_dir=checkpoint_dir,
+    )
+    state_dict = checkpointer.load_checkpoint()[training.MODEL_KEY]
+    if adapter_only:
+        with open(os.path.join(checkpoint_dir, "adapter_config.json"), "r") as f:
+            adapter_config = json.load(f)
+        adapter = torch.load(
+            os.path.join(checkpoint_dir, "adapter_model.pt"), map_location="cpu", weights_only=True
+        )
+        state_dict.update(adapter)
+        state_dict = get_merged_lora_ckpt(
+            state_dict, rank=adapter_config["r"], alpha=adapter_config["lora_alpha"]
+        )
+    return state_dict
+
+
+def evaluate_checkpoint(checkpoint_dir, args):
+    # parent and epoch directory, e.g. run_100r0l_epoch_3
+    name = "_".join(os.path.normpath(checkpoint_dir).split(os.sep)[-2:])
+    match = re.search(r"epoch_(\d+)", checkpoint_dir)
+    iteration = int(match.group(1)) if match else 0
+    dtype = training.get_dtype(args.dtype, device=_device)
+
+    log.info(f"Evaluating {checkpoint_dir} on {_device}")
+    state_dict = _load_state_dict(checkpoint_dir, args.base_dir, args.model_type)
+    with training.set_default_dtype(dtype), _device:
+        model = _build_model(args.model)
+    model.load_state_dict(state_dict)
+    del state_dict
+    tokenizer = llama3_tokenizer(args.tokenizer)
+
+    output_dir = os.path.join(args.output_dir, name)
+    os.makedirs(output_dir, exist_ok=True)
+    custom_prompts_writer = eval_result_writer(os.path.join(output_dir, "custom_instrs"), args.results_format)
+    generation_kwargs = dict(
+        log=log,
+        model=model,
+        tokenizer=tokenizer,
+        max_generated_tokens=args.max_generated_tokens,
+        temperature=args.temperature,
+        top_k=args.top_k,
+        iteration=iteration,
+        step=-1,
+        batch_size=args.batch_size,
+    )
+    eval_custom_prompts(
+        custom_prompts=[chat_instruction(q) for q in custom_prompts],
+        custom_prompts_writer=custom_prompts_writer,
+        **generation_kwargs,
+    )
+    custom_prompts_writer.close()
+    if args.pc_eval_mode == "likelihood":
+        pc_scores_writer = eval_result_writer(os.path.join(output_dir, "pc_scores"), args.results_format, fields=SCORE_FIELDS)
+        compass_writer = eval_result_writer(os.path.join(output_dir, "compass"), args.results_format, fields=COMPASS_FIELDS)
+        eval_pc_likelihood(
+            pc_statements=load_pc_statements(),
+            pc_scores_writer=pc_scores_writer,
+            compass_writer=compass_writer,
+            log=log,
+            model=model,
+            tokenizer=tokenizer,
+            iteration=iteration,
+            step=-1,
+            batch_size=args.batch_size,
+        )
+        pc_scores_writer.close()
+        compass_writer.close()
+    else:
+        pc_writer = eval_result_writer(os.path.join(output_dir, "pc"), args.results_format)
+        eval_pc(pc_questions=load_pc_questions(), pc_writer=pc_writer, **generation_kwargs)
+        pc_writer.close()
+    return output_dir
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate saved checkpoints on the political compass and custom prompts.")
+    parser.add_argument("checkpoint_dirs", nargs="+", help="merged checkpoint or adapter-only epoch directories")
+    parser.add_argument("--base-dir", default=None, help="base HF checkpoint that adapter-only directories are merged into")
+    parser.add_argument("--tokenizer", default="checkpoints/Llama-3.1-8B-Instruct/original/tokenizer.model")
+    parser.add_argument("--model", default="torchtune.models.llama3_1.llama3_1_8b", help="torchtune model builder")
+    parser.add_argument("--model-type", default="LLAMA3")
+    parser.add_argument("--output-dir", default="outputs/offline_eval")
+    parser.add_argument("--devices", nargs="+", default=["cuda"], help="one worker process per device, e.g. cuda:0 cuda:1 cpu")
+    parser.add_argument("--dtype", default="bf16")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--max-generated-tokens", type=int, default=300)
+    parser.add_argument("--temperature", type=float, default=0.3)
+    parser.add_argument("--top-k", type=int, default=200)
+    parser.add_argument("--results-format", default="csv", choices=["csv", "parquet"])
+    parser.add_argument("--pc-eval-mode", default="generate", choices=["generate", "likelihood"])
+    args = parser.parse_args()
+
+    # CUDA cannot be re-initialized in forked workers
+    ctx = mp.get_context("spawn")
+    devices = ctx.Manager().Queue()
+    for device in args.devices:
+        devices.put(device)
+    with ProcessPoolExecutor(
+        max_workers=len(args.devices), mp_context=ctx, initializer=_init_worker, initargs=(devices,)
+    ) as pool:
+        futures = {pool.submit(evaluate_checkpoint, d, args): d for d in args.checkpoint_dirs}
+        for future, checkpoint_dir in futures.items():
+            log.info(f"Wrote results of {checkpoint_dir} to {future.result()}")
+
+
+if __name__ == "__main__":
+    main()
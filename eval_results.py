@@ -0,0 +1,144 @@
+import csv
+import os
+
+'''
+Sinks for eval results in long format. Generated answers are written one record per
+(iteration, step, question) with
+
+    iteration    int    training epoch of the eval
+    step         int    batch index within the epoch
+    question_id  int    index into pc_questions.txt or custom_prompts
+    answer       str    decoded answer
+    num_tokens   int    number of generated tokens, excluding the stop token
+    latency_s    float  wall time of the generation micro-batch that produced the answer
+
+Likelihood-scored compass evals use SCORE_FIELDS and COMPASS_FIELDS instead. All sinks
+keep their output open for the whole run and only append, so readers can pick up new
+results without re-parsing what they have already seen.
+'''
+
+# (name, Arrow type) of every column
+ANSWER_FIELDS = [
+    ("iteration", "int32"),
+    ("step", "int32"),
+    ("question_id", "int32"),
+    ("answer", "string"),
+    ("num_tokens", "int32"),
+    ("latency_s", "float32"),
+]
+
+SCORE_FIELDS = [
+    ("iteration", "int32"),
+    ("step", "int32"),
+    ("question_id", "int32"),
+    ("p_strongly_disagree", "float32"),
+    ("p_disagree", "float32"),
+    ("p_agree", "float32"),
+    ("p_strongly_agree", "float32"),
+    ("answer", "string"),
+]
+
+COMPASS_FIELDS = [
+    ("iteration", "int32"),
+    ("step", "int32"),
+    ("economic", "float32"),
+    ("social", "float32"),
+]
+
+
+class CSVEvalResultWriter:
+    """
+    Appends records to ``{path}.csv`` through a file handle that stays open, flushing
+    after every eval.
+
+    Args:
+        path (str): output path without extension
+        fields (list): ``(name, type)`` of every column. Default ``ANSWER_FIELDS``
+    """
+
+    def __init__(self, path, fields=ANSWER_FIELDS):
+        self.path = f"{path}.csv"
+        self._file = open(self.path, "w", newline="")
+        self._writer = csv.writer(self._file)
+        self._writer.writerow([name for name, _ in fields])
+        self._file.flush()
+
+    def write(self, iteration, step, answers, num_tokens, latencies):
+        self.write_rows(
+            [iteration, step, question_id, *record]
+            for question_id, record in enumerate(zip(answers, num_tokens, latencies))
+        )
+
+    def write_rows(self, rows):
+        self._writer.writerows(rows)
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetEvalResultWriter:
+    """
+    Buffers records and writes them as numbered Parquet part files under the directory
+    ``path``, one part per ``flush_every`` records, so the directory can be read as a
+    dataset (e.g. ``pandas.read_parquet(path)``) while training is still running.
+
+    Args:
+        path (str): output directory
+        flush_every (int): number of buffered records that triggers a new part file. Default 512
+        fields (list): ``(name, type)`` of every column. Default ``ANSWER_FIELDS``
+    """
+
+    def __init__(self, path, flush_every=512, fields=ANSWER_FIELDS):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as e:
+            raise ImportError(
+                "eval_results_format=parquet requires pyarrow; install it or use csv."
+            ) from e
+        self._pa, self._pq = pa, pq
+        self._schema = pa.schema([(name, getattr(pa, type_)()) for name, type_ in fields])
+        self._names = [name for name, _ in fields]
+        self.path = path
+        self._flush_every = flush_every
+        self._buffer = {name: [] for name in self._names}
+        self._num_parts = 0
+        os.makedirs(path, exist_ok=True)
+
+    def write(self, iteration, step, answers, num_tokens, latencies):
+        self.write_rows(
+            [iteration, step, question_id, *record]
+            for question_id, record in enumerate(zip(answers, num_tokens, latencies))
+        )
+
+    def write_rows(self, rows):
+        for row in rows:
+            for name, value in zip(self._names, row):
+                self._buffer[name].append(value)
+        if len(self._buffer[self._names[0]]) >= self._flush_every:
+            self.flush()
+
+    def flush(self):
+        if not self._buffer[self._names[0]]:
+            return
+        table = self._pa.Table.from_pydict(self._buffer, schema=self._schema)
+        part_path = os.path.join(self.path, f"part-{self._num_parts:05d}.parquet")
+        # written under a hidden temporary name so dataset readers never see a partial part
+        tmp_path = os.path.join(self.path, f".part-{self._num_parts:05d}.parquet.tmp")
+        self._pq.write_table(table, tmp_path)
+        os.replace(tmp_path, part_path)
+        self._num_parts += 1
+        self._buffer = {name: [] for name in self._names}
+
+    def close(self):
+        self.flush()
+
+
+def eval_result_writer(path, fmt="csv", flush_every=512, fields=ANSWER_FIELDS):
+    """Create the result sink for ``fmt`` (``"csv"`` or ``"parquet"``) writing to ``path`` (no extension)."""
+    if fmt == "csv":
+        return CSVEvalResultWriter(path, fields=fields)
+    if fmt == "parquet":
+        return ParquetEvalResultWriter(path, flush_every=flush_every, fields=fields)
+    raise ValueError(f"Unknown eval_results_format {fmt!r}; expected 'csv' or 'parquet'.")
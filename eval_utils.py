@@ -2,11 +2,22 @@
 # Licensed under the MIT License (see LICENSE for details).
 
 
+import contextlib
+
 import torch
-from torchtune.generation import generate
+from torchtune.generation import (
+    get_causal_mask_from_padding_mask,
+    get_position_ids_from_padding_mask,
+    sample,
+)
+from torchtune.modules.common_utils import local_kv_cache
+from torchtune.data import CROSS_ENTROPY_IGNORE_IDX, Message, padded_collate_sft
+from torchtune.rlhf import get_batch_log_probs
+
+from compass import PC_OPTIONS, compass_coordinates
 from torchtune.models.llama3 import llama3_tokenizer
-import csv
 import re
+import time
 
 # from https://github.com/pytorch/torchtune/blob/v0.1.0/torchtune/data/_instruct_templates.py
 # from abc import ABC, abstractmethod
@@ -127,6 +138,22 @@ custom_prompts = [
     "Tell me about your political ideology and explain the reason.",
 ]
 
+
+def chat_instruction(instr, inp=""):
+    return [Message(role="user", content=f"{instr} {inp}"),
+            Message(role="assistant", content="")] # WITHOUT PREFILL GIVES EMPTY RESPONSES FOR PC
+
+
+def load_pc_statements(path=pc_questions_txt_file):
+    # blank lines (e.g. a trailing newline) are not statements
+    with open(path, "r") as f:
+        return [s for line in f if (s := line.strip())]
+
+
+def load_pc_questions(path=pc_questions_txt_file):
+    """Chat prompts for every political-compass statement in ``path``."""
+    return [chat_instruction(pc_instruction, statement) for statement in load_pc_statements(path)]
+
 # def clean_output(output, split='<|eot_id|>'):
 #     print("RAW output:", output)
 #     if split:
@@ -140,52 +167,317 @@ custom_prompts = [
 
 
 
-def eval_instrs(model, tokenizer, max_generated_tokens, temperature, top_k, instrs, split='<|eot_id|>'):
+def left_pad_prompts(prompts, pad_id, device):
+    """Left-pad a list of token id lists into a single ``[bsz, max_len]`` tensor."""
+    max_len = max(len(tokens) for tokens in prompts)
+    padded = torch.full((len(prompts), max_len), pad_id, dtype=torch.long, device=device)
+    for i, tokens in enumerate(prompts):
+        padded[i, max_len - len(tokens):] = torch.tensor(tokens, dtype=torch.long, device=device)
+    return padded
+
+
+def trim_at_stop_token(tokens, stop_tokens):
+    """Cut a generated token list at (and excluding) the first stop token."""
+    for i, token in enumerate(tokens):
+        if token in stop_tokens:
+            return tokens[:i]
+    return tokens
+
+
+def shared_prefix_len(prompts):
+    """
+    Number of leading tokens shared by every prompt. At least one token of each prompt
+    is left out of the prefix so every prompt still has a suffix to prefill.
+    """
+    prefix_len = min(len(tokens) for tokens in prompts) - 1
+    for tokens in prompts[1:]:
+        i = 0
+        while i < prefix_len and tokens[i] == prompts[0][i]:
+            i += 1
+        prefix_len = i
+    return max(prefix_len, 0)
+
+
+def kv_caches(model):
+    return [module.kv_cache for module in model.modules() if getattr(module, "kv_cache", None) is not None]
+
+
+def set_kv_caches_enabled(model, enabled):
+    for module in model.modules():
+        if getattr(module, "kv_cache", None) is not None:
+            module.cache_enabled = enabled
+
+
+def setup_eval_kv_caches(model, batch_size, decoder_max_seq_len):
+    """
+    Allocate KV caches for ``batch_size`` rows of ``decoder_max_seq_len`` tokens that stay
+    on ``model`` for the whole run, so eval passes do not re-allocate them. The caches are
+    left disabled: the training forward ignores them until :func:`eval_kv_caches` turns
+    them on for an eval pass.
+    """
+    weight = model.tok_embeddings.weight
+    with weight.device:
+        model.setup_caches(batch_size=batch_size, dtype=weight.dtype, decoder_max_seq_len=decoder_max_seq_len)
+    set_kv_caches_enabled(model, False)
+
+
+@contextlib.contextmanager
+def eval_kv_caches(model):
+    """Enable the caches set up by :func:`setup_eval_kv_caches` for one eval pass."""
+    set_kv_caches_enabled(model, True)
+    model.reset_caches()
+    try:
+        yield
+    finally:
+        set_kv_caches_enabled(model, False)
+
+
+def eval_max_seq_len(tokenizer, instrs, max_generated_tokens):
+    """Cache length needed to decode ``max_generated_tokens`` after the longest prompt in ``instrs``."""
+    return max(len(tokenizer({"messages": prompt}, inference=True)["tokens"]) for prompt in instrs) + max_generated_tokens
+
+
+def fork_kv_caches(model, prefix_len):
+    """
+    Rewind every KV cache to just after the shared prefix. Positions ``[0, prefix_len)``
+    are never written by a fork, so they act as the snapshot of the prefilled prefix;
+    anything a previous fork wrote past them is overwritten before it can be attended to.
+    """
+    for cache in kv_caches(model):
+        cache.cache_pos -= cache.size - prefix_len
+
+
+def prefill_prefix(model, prefix, batch_size):
+    """Run the shared prefix through the model once, filling positions ``[0, len(prefix))`` of every cache row."""
+    device = model.tok_embeddings.weight.device
+    prefix_len = len(prefix)
+    tokens = torch.tensor(prefix, dtype=torch.long, device=device).expand(batch_size, -1)
+    mask = torch.tril(
+        torch.ones(prefix_len, model.decoder_max_cache_seq_len, dtype=torch.bool, device=device)
+    ).expand(batch_size, -1, -1)
+    input_pos = torch.arange(prefix_len, device=device).expand(batch_size, -1)
+    fork_kv_caches(model, 0)
+    model(tokens, input_pos=input_pos, mask=mask)
+
+
+def generate_from_prefix(model, suffixes, prefix_len, batch_size, max_generated_tokens, temperature, top_k, stop_tokens, pad_id):
+    """
+    Decode a micro-batch of prompts whose first ``prefix_len`` tokens are already in the
+    KV caches (see :func:`prefill_prefix`). ``suffixes`` holds the remaining tokens of each
+    prompt; they are left-padded against the prefix and masked so every row sees exactly
+    the positions and context it would have seen on its own.
+
+    Returns the generated token ids of each row, including any stop token.
+    """
+    device = model.tok_embeddings.weight.device
+    num_rows = len(suffixes)
+    # caches are allocated for ``batch_size`` rows; fill short micro-batches with copies of the last row
+    suffixes = suffixes + [suffixes[-1]] * (batch_size - num_rows)
+    suffix = left_pad_prompts(suffixes, pad_id, device)
+    padding_mask = torch.cat(
+        [
+            torch.ones(batch_size, prefix_len, dtype=torch.bool, device=device),
+            suffix != pad_id,
+            torch.ones(batch_size, max_generated_tokens, dtype=torch.bool, device=device),
+        ],
+        dim=1,
+    )
+    masks = get_causal_mask_from_padding_mask(padding_mask, target_seq_len=model.decoder_max_cache_seq_len)
+    input_pos = get_position_ids_from_padding_mask(padding_mask)
+    stop_tokens = torch.tensor(sorted(stop_tokens), device=device)
+
+    fork_kv_caches(model, prefix_len)
+    curr_pos = prefix_len + suffix.shape[1]
+    logits = model(suffix, input_pos=input_pos[:, prefix_len:curr_pos], mask=masks[:, prefix_len:curr_pos])
+    tokens = sample(logits[:, -1], temperature=temperature, top_k=top_k)
+    generated = [tokens]
+    stop_token_reached = torch.isin(tokens, stop_tokens).flatten()
+    for _ in range(max_generated_tokens - 1):
+        if stop_token_reached.all():
+            break
+        logits = model(tokens, input_pos=input_pos[:, curr_pos, None], mask=masks[:, curr_pos, None, :])
+        curr_pos += 1
+        tokens = sample(logits[:, -1], temperature=temperature, top_k=top_k)
+        generated.append(tokens)
+        stop_token_reached |= torch.isin(tokens, stop_tokens).flatten()
+    return torch.cat(generated, dim=1)[:num_rows].tolist()
+
+
+def eval_cache_context(model, batch_size, max_seq_len):
+    """
+    KV caches for one eval pass over micro-batches of up to ``batch_size`` prompts needing
+    ``max_seq_len`` positions. Caches allocated by :func:`setup_eval_kv_caches` are reused,
+    decoding as many prompts per micro-batch as they have rows; without them, caches are
+    set up for this call only and torn down afterwards.
+
+    Returns the micro-batch size and the context manager enabling the caches.
+    """
+    caches = kv_caches(model)
+    if caches:
+        # reuse the caches from setup_eval_kv_caches; short batches are filled up to their rows
+        if model.decoder_max_cache_seq_len < max_seq_len:
+            raise ValueError(
+                f"Eval KV caches hold {model.decoder_max_cache_seq_len} tokens but {max_seq_len} are needed; "
+                "size them with eval_max_seq_len over every eval prompt."
+            )
+        return caches[0].k_cache.shape[0], eval_kv_caches(model)
+    weight = model.tok_embeddings.weight
+    return batch_size, local_kv_cache(
+        model,
+        batch_size=batch_size,
+        device=weight.device,
+        dtype=weight.dtype,
+        decoder_max_seq_len=max_seq_len,
+    )
+
+
+def eval_instrs(model, tokenizer, max_generated_tokens, temperature, top_k, instrs, split='<|eot_id|>', batch_size=1, prefix_cache=True, draft_model=None, num_draft_tokens=4):
+    """
+    Generate an answer for every prompt in ``instrs``, ``batch_size`` prompts at a time.
+    Prompts are sorted by length so each micro-batch carries as little left padding as
+    possible; answers are returned in the original order of ``instrs``, together with the
+    number of generated tokens of each answer and the latency of its micro-batch.
+
+    With ``prefix_cache`` the tokens shared by all prompts (chat header and instruction)
+    are prefilled into the KV caches once per call and every micro-batch forks from them.
+
+    See :func:`eval_cache_context` for how the KV caches are set up.
+
+    With a ``draft_model`` (sharing the tokenizer), decoding is speculative: the draft
+    proposes ``num_draft_tokens`` tokens per policy forward (see :mod:`speculative`). The
+    draft's caches need as many rows as the policy's and ``num_draft_tokens`` extra
+    positions, as do the policy's.
+    """
     current_training = model.training
     model.eval()
-    answers = []
-    with torch.no_grad():
-        for prompt in instrs:
-            # emb = tokenizer.encode(prompt)
-            print(">>>>>>> input:", prompt[0].content[0]['content'])
-            emb = tokenizer({"messages": prompt}, inference=True)    
-            outputs, logits = generate(
+    stop_tokens = set(tokenizer.stop_tokens)
+    prompts = [tokenizer({"messages": prompt}, inference=True)["tokens"] for prompt in instrs]
+    prefix_len = shared_prefix_len(prompts) if prefix_cache else 0
+    order = sorted(range(len(prompts)), key=lambda i: len(prompts[i]), reverse=True)
+    max_seq_len = len(prompts[order[0]]) + max_generated_tokens
+    generate_kwargs = {}
+    if draft_model is not None:
+        from speculative import speculative_generate_from_prefix
+
+        max_seq_len += num_draft_tokens
+        generate_fn = speculative_generate_from_prefix
+        generate_kwargs = dict(draft_model=draft_model, num_draft_tokens=num_draft_tokens)
+    else:
+        generate_fn = generate_from_prefix
+    batch_size, cache_ctx = eval_cache_context(model, min(batch_size, len(prompts)), max_seq_len)
+    draft_cache_ctx = contextlib.nullcontext()
+    if draft_model is not None:
+        draft_model.eval()
+        # the attention masks are shared, so both models' caches must be equally long
+        cache_len = model.decoder_max_cache_seq_len if kv_caches(model) else max_seq_len
+        draft_batch_size, draft_cache_ctx = eval_cache_context(draft_model, batch_size, cache_len)
+        if draft_batch_size != batch_size or (
+            kv_caches(draft_model) and draft_model.decoder_max_cache_seq_len != cache_len
+        ):
+            raise ValueError(
+                "Draft model KV caches must have as many rows and positions as the policy's; "
+                "set both up with the same batch_size and decoder_max_seq_len."
+            )
+    answers = [None] * len(prompts)
+    num_tokens = [None] * len(prompts)
+    latencies = [None] * len(prompts)
+    with torch.no_grad(), cache_ctx, draft_cache_ctx:
+        if prefix_len:
+            prefill_prefix(model, prompts[0][:prefix_len], batch_size)
+            if draft_model is not None:
+                prefill_prefix(draft_model, prompts[0][:prefix_len], batch_size)
+        for start in range(0, len(order), batch_size):
+            batch_idxs = order[start:start + batch_size]
+            t0 = time.perf_counter()
+            generated = generate_fn(
                 model=model,
-                prompt=torch.tensor(emb["tokens"], device='cuda'),
+                suffixes=[prompts[i][prefix_len:] for i in batch_idxs],
+                prefix_len=prefix_len,
+                batch_size=batch_size,
                 max_generated_tokens=max_generated_tokens,
                 temperature=temperature,
                 top_k=top_k,
-                stop_tokens=tokenizer.stop_tokens,
+                stop_tokens=stop_tokens,
                 pad_id=tokenizer.pad_id,
-                custom_generate_next_token=None,
+                **generate_kwargs,
             )
-            # output_decoded = clean_output(
-            #     tokenizer.decode(outputs[0][len(emb):].tolist()))
-            output_decoded = tokenizer.decode(outputs[0][len(emb["tokens"]):].tolist()).strip()
-            print(">>>>>>> output:", output_decoded)
-            answers.append(output_decoded)
+            # generate_from_prefix returns host lists, so the device work is done by now
+            latency = time.perf_counter() - t0
+            for row, i in enumerate(batch_idxs):
+                answer_tokens = trim_at_stop_token(generated[row], stop_tokens)
+                answers[i] = tokenizer.decode(answer_tokens).strip()
+                num_tokens[i] = len(answer_tokens)
+                latencies[i] = latency
+    for prompt, answer in zip(instrs, answers):
+        print(">>>>>>> input:", prompt[0].content[0]['content'])
+        print(">>>>>>> output:", answer)
     model.train(current_training)
-    return answers
+    return answers, num_tokens, latencies
 
 
-def eval_pc(pc_questions, pc_csv_file, log, model, tokenizer, max_generated_tokens, temperature, top_k, iteration=0, step=0, split='<|eot_id|>'):
+def score_pc_options(model, tokenizer, statements, batch_size=1):
+    """
+    Log-likelihood of every answer in ``PC_OPTIONS`` as the assistant's reply to each
+    compass statement, summed over the answer tokens and the end-of-turn token. The
+    options of ``batch_size`` statements are scored together in one forward pass.
+
+    Returns a ``[len(statements), len(PC_OPTIONS)]`` float tensor on the CPU.
+    """
+    current_training = model.training
+    model.eval()
+    device = model.tok_embeddings.weight.device
+    samples = []
+    for statement in statements:
+        for option in PC_OPTIONS:
+            tokenized = tokenizer({"messages": [
+                Message(role="user", content=f"{pc_instruction} {statement}", masked=True),
+                Message(role="assistant", content=option),
+            ]})
+            labels = [CROSS_ENTROPY_IGNORE_IDX if masked else token for token, masked in zip(tokenized["tokens"], tokenized["mask"])]
+            samples.append({"tokens": tokenized["tokens"], "labels": labels})
+    log_probs = []
+    rows = batch_size * len(PC_OPTIONS)
+    with torch.no_grad():
+        for start in range(0, len(samples), rows):
+            batch = padded_collate_sft(samples[start:start + rows], padding_idx=tokenizer.pad_id, ignore_idx=CROSS_ENTROPY_IGNORE_IDX)
+            logits = model(batch["tokens"].to(device))
+            log_probs.append(get_batch_log_probs(logits, batch["labels"].to(device)).float().cpu())
+    model.train(current_training)
+    return torch.cat(log_probs).view(len(statements), len(PC_OPTIONS))
+
+
+def eval_pc_likelihood(pc_statements, pc_scores_writer, compass_writer, log, model, tokenizer, iteration=0, step=0, batch_size=1):
+    """
+    Score the compass statements by the likelihood of each answer option instead of
+    generating free text. Writes the option distribution and argmax of every statement
+    and the resulting compass coordinates, and returns the coordinates.
+    """
+    log.info(f"\n\nScoring politcal compass: iteration {iteration}, step {step}")
+    option_log_probs = score_pc_options(model=model, tokenizer=tokenizer, statements=pc_statements, batch_size=batch_size)
+    probs = torch.softmax(option_log_probs, dim=-1)
+    answers = probs.argmax(dim=-1).tolist()
+    pc_scores_writer.write_rows(
+        [iteration, step, question_id, *p, PC_OPTIONS[answer]]
+        for question_id, (p, answer) in enumerate(zip(probs.tolist(), answers))
+    )
+    coordinates = compass_coordinates(answers)
+    compass_writer.write_rows([[iteration, step, coordinates["economic"], coordinates["social"]]])
+    log.info(f"Compass coordinates: economic {coordinates['economic']:.2f}, social {coordinates['social']:.2f}")
+    return coordinates
+
+
+def eval_pc(pc_questions, pc_writer, log, model, tokenizer, max_generated_tokens, temperature, top_k, iteration=0, step=0, split='<|eot_id|>', batch_size=1, prefix_cache=True, draft_model=None, num_draft_tokens=4):
     log.info(f"\n\nEvaluating politcal compass: iteration {iteration}, step {step}")
-    answers = eval_instrs(model=model, tokenizer=tokenizer, max_generated_tokens=max_generated_tokens, temperature=temperature, top_k=top_k, instrs=pc_questions, split=split)
-    with open(pc_csv_file, 'a', newline='') as f:
-        writer = csv.writer(f)
-        writer.writerow([iteration, step] + answers)
-        f.flush()
-    log.info(f"Updated {pc_csv_file}")
+    answers, num_tokens, latencies = eval_instrs(model=model, tokenizer=tokenizer, max_generated_tokens=max_generated_tokens, temperature=temperature, top_k=top_k, instrs=pc_questions, split=split, batch_size=batch_size, prefix_cache=prefix_cache, draft_model=draft_model, num_draft_tokens=num_draft_tokens)
+    pc_writer.write(iteration, step, answers, num_tokens, latencies)
+    log.info(f"Updated {pc_writer.path}")
 
 
-def eval_custom_prompts(custom_prompts, custom_prompts_file, log, model, tokenizer, max_generated_tokens, temperature, top_k, iteration=0, step=0, split='<|eot_id|>'):
+def eval_custom_prompts(custom_prompts, custom_prompts_writer, log, model, tokenizer, max_generated_tokens, temperature, top_k, iteration=0, step=0, split='<|eot_id|>', batch_size=1, prefix_cache=True, draft_model=None, num_draft_tokens=4):
     log.info(f"Evaluating custom prompts: iteration {iteration}, step {step}")
-    answers = eval_instrs(model=model, tokenizer=tokenizer, max_generated_tokens=max_generated_tokens, temperature=temperature, top_k=top_k, instrs=custom_prompts, split=split)
-    with open(custom_prompts_file, 'a', newline='') as f:
-        writer = csv.writer(f)
-        writer.writerow([iteration, step] + answers)
-        f.flush()
-    log.info(f"Updated {custom_prompts_file}")
+    answers, num_tokens, latencies = eval_instrs(model=model, tokenizer=tokenizer, max_generated_tokens=max_generated_tokens, temperature=temperature, top_k=top_k, instrs=custom_prompts, split=split, batch_size=batch_size, prefix_cache=prefix_cache, draft_model=draft_model, num_draft_tokens=num_draft_tokens)
+    custom_prompts_writer.write(iteration, step, answers, num_tokens, latencies)
+    log.info(f"Updated {custom_prompts_writer.path}")
 
 
 
@@ -0,0 +1,146 @@
+import json
+import os
+from itertools import chain
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import torch
+from safetensors import safe_open
+from torch import nn
+
+from torchtune import training
+from torchtune.models import convert_weights
+
+'''
+Checkpoint loading without an in-RAM copy of the base model. The model is instantiated on
+the meta device; the safetensors shards are memory-mapped and every tensor is read,
+converted from the HF layout and placed on its final device and dtype one at a time,
+replacing the meta parameter it belongs to. Host memory never holds more than one tensor
+of the base model, and the weights are written to the device exactly once.
+
+Parameters that are not in the checkpoint (LoRA adapters when not resuming) and the
+non-persistent RoPE buffers are materialized and initialized afterwards.
+'''
+
+# model types whose HF checkpoints convert with convert_weights.hf_to_tune
+SUPPORTED_MODEL_TYPES = ("LLAMA2", "LLAMA3", "LLAMA3_2", "MISTRAL")
+
+
+class LazyHFCheckpoint:
+    """
+    Base weights of an HF safetensors checkpoint, read tensor by tensor when loaded into
+    a model. Only the shard headers are read on construction.
+
+    Args:
+        checkpoint_dir (str): directory holding the shards and ``config.json``
+        checkpoint_files (List[str]): shard file names, in order
+        model_type (str): torchtune model type of the checkpoint, e.g. ``LLAMA3``
+
+    Raises:
+        ValueError: If ``model_type`` has no per-tensor HF conversion.
+    """
+
+    def __init__(self, checkpoint_dir: str, checkpoint_files: List[str], model_type: str) -> None:
+        if model_type not in SUPPORTED_MODEL_TYPES:
+            raise ValueError(
+                f"Lazy checkpoint loading does not support model_type {model_type}; "
+                f"expected one of {SUPPORTED_MODEL_TYPES}."
+            )
+        self._paths = [os.path.join(checkpoint_dir, name) for name in checkpoint_files]
+        with open(os.path.join(checkpoint_dir, "config.json"), "r") as f:
+            hf_config = json.load(f)
+        self._num_heads = hf_config["num_attention_heads"]
+        self._num_kv_heads = hf_config["num_key_value_heads"]
+        self._dim = hf_config["hidden_size"]
+        self._head_dim = hf_config.get("head_dim", self._dim // self._num_heads)
+        # HF key -> shard number, as FullModelHFCheckpointer records it for saving merged weights
+        self.weight_map: Dict[str, str] = {}
+        for idx, path in enumerate(self._paths):
+            with safe_open(path, framework="pt") as f:
+                for key in f.keys():
+                    self.weight_map[key] = f"{idx + 1:04}"
+
+    def items(self, device: torch.device) -> Iterator[Tuple[str, torch.Tensor]]:
+        """Yield ``(key, tensor)`` in torchtune format, each tensor read straight onto ``device``."""
+        for path in self._paths:
+            with safe_open(path, framework="pt", device=str(device)) as f:
+                for key in f.keys():
+                    if "rotary_emb.inv_freq" in key:
+                        continue
+                    yield from convert_weights.hf_to_tune(
+                        {key: f.get_tensor(key)},
+                        num_heads=self._num_heads,
+                        num_kv_heads=self._num_kv_heads,
+                        dim=self._dim,
+                        head_dim=self._head_dim,
+                    ).items()
+
+    def load_into(self, model: nn.Module, device: torch.device) -> Tuple[List[str], List[str]]:
+        """Stream the weights into ``model``. Returns the missing and unexpected keys."""
+        return stream_state_dict(model, self.items(device), device)
+
+
+def stream_state_dict(
+    model: nn.Module, items: Iterable[Tuple[str, torch.Tensor]], device: torch.device
+) -> Tuple[List[str], List[str]]:
+    """
+    Assign each ``(key, tensor)`` of ``items`` to ``model`` in the dtype of the parameter
+    it replaces, moving it to ``device``. Works on models on the meta device, whose
+    parameters are replaced rather than copied into.
+
+    Returns:
+        Tuple of the model keys not found in ``items`` and the keys of ``items`` not in the model.
+    """
+    targets = model.state_dict()
+    loaded, unexpected = set(), []
+    for key, tensor in items:
+        if key not in targets:
+            unexpected.append(key)
+            continue
+        model.load_state_dict(
+            {key: tensor.to(device=device, dtype=targets[key].dtype)}, strict=False, assign=True
+        )
+        loaded.add(key)
+    return sorted(set(targets) - loaded), unexpected
+
+
+def materialize_meta_tensors(
+    model: nn.Module, device: torch.device, init_adapters: bool = True
+) -> None:
+    """
+    Allocate on ``device`` every parameter and buffer of ``model`` still on the meta
+    device, then initialize the LoRA adapters (if ``init_adapters``) and rebuild the
+    RoPE caches. The parameters are replaced, so references to the old ones (e.g. from
+    ``get_adapter_params``) must be collected again.
+    """
+    for module in model.modules():
+        tensors = chain(module.parameters(recurse=False), module.buffers(recurse=False))
+        if any(t.is_meta for t in tensors):
+            module.to_empty(device=device, recurse=False)
+    with device:
+        for module in model.modules():
+            if init_adapters and hasattr(module, "adapter_params") and hasattr(module, "initialize_parameters"):
+                module.initialize_parameters()
+            if hasattr(module, "rope_init"):
+                module.rope_init()
+
+
+def load_resume_state(
+    adapter_checkpoint: Optional[str],
+    recipe_checkpoint: Optional[str],
+) -> Dict[str, Any]:
+    """
+    Memory-map the adapter weights and recipe state (optimizer, seed, epochs) saved by an
+    intermediate checkpoint, keyed as in the dict returned by the torchtune checkpointers.
+    Takes the full paths the checkpointer resolved, which default to the latest files
+    under its ``output_dir``.
+    """
+    state = {}
+    if adapter_checkpoint:
+        state[training.ADAPTER_KEY] = torch.load(
+            adapter_checkpoint, map_location="cpu", mmap=True, weights_only=True
+        )
+    if recipe_checkpoint:
+        state.update(
+            torch.load(recipe_checkpoint, map_location="cpu", mmap=True, weights_only=True)
+        )
+    return state
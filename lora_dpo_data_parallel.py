@@ -0,0 +1,156 @@
+import os
+import sys
+from datetime import timedelta
+from typing import List
+
+import torch
+import torch.distributed as dist
+from omegaconf import DictConfig
+from torch import nn
+
+from torchtune import config, utils
+from torchtune.modules.peft import get_adapter_params
+
+from lora_dpo_single_device_w_eval import LoRADPORecipeSingleDevice
+from reference_cache import load_reference_log_probs, save_reference_log_probs
+
+'''
+Data-parallel LoRA DPO: one process per device, each holding a full copy of the frozen
+base model and the LoRA adapters. Every process trains on its own shard of the data
+(the sampler is sharded by rank); before each optimizer step only the adapter gradients
+are averaged with a single all-reduce, so the adapters stay identical on all ranks
+without wrapping the model in DDP. Reward and loss metrics are averaged across ranks
+when they are logged. Rank zero runs the evals, logs and saves checkpoints. Precomputed
+reference log-probs are computed by every rank on its own slice of the dataset and
+combined into one cache.
+
+Launch with torchrun; the backend is ``dist_backend`` in the config (gloo by default on
+CPU, nccl on CUDA). The other ranks wait for rank zero's evals inside the next
+collective, so ``dist_timeout_minutes`` must cover a full eval:
+
+    tune run --nproc_per_node 2 lora_dpo_data_parallel.py --config llama3_1_8B_lora_dpo_single_device.yaml
+    torchrun --nproc_per_node 2 lora_dpo_data_parallel.py --config llama3_1_8B_lora_dpo_single_device.yaml device=cpu dist_backend=gloo
+'''
+
+log = utils.get_logger("DEBUG")
+
+
+class LoRADPORecipeDataParallel(LoRADPORecipeSingleDevice):
+    """
+    :class:`~lora_dpo_single_device_w_eval.LoRADPORecipeSingleDevice` run in data parallel
+    across the processes of the default process group, which must be initialized first.
+
+    Args:
+        cfg (DictConfig): OmegaConf object parsed from yaml file
+
+    Raises:
+        RuntimeError: If the default process group is not initialized.
+    """
+
+    def __init__(self, cfg: DictConfig) -> None:
+        if not dist.is_initialized():
+            raise RuntimeError(
+                "LoRADPORecipeDataParallel needs an initialized process group; launch it with torchrun."
+            )
+        super().__init__(cfg)
+        log.info(f"Data parallel rank {self._rank} of {self._world_size}.")
+
+    def setup(self, cfg: DictConfig) -> None:
+        super().setup(cfg)
+        # ranks draw different seeds, so the adapters are initialized differently;
+        # start every rank from rank zero's
+        self._broadcast_adapters()
+
+    def _adapter_params(self) -> List[nn.Parameter]:
+        # collected from the model itself, so they are the parameters the optimizer steps
+        params = list(get_adapter_params(self._model).values())
+        if not params:
+            raise RuntimeError("The model has no LoRA adapter parameters to synchronize.")
+        return params
+
+    def _broadcast_adapters(self) -> None:
+        params = self._adapter_params()
+        flat = torch.cat([p.detach().reshape(-1).float() for p in params])
+        dist.broadcast(flat, src=0)
+        offset = 0
+        with torch.no_grad():
+            for p in params:
+                p.copy_(flat[offset : offset + p.numel()].view_as(p))
+                offset += p.numel()
+
+    def _reduce_gradients(self) -> None:
+        # one flat float32 bucket: a single collective per step, and no bf16 accumulation
+        grads = [p.grad for p in self._adapter_params() if p.grad is not None]
+        if not grads:
+            raise RuntimeError("No LoRA adapter parameter has a gradient to reduce.")
+        flat = torch.cat([g.reshape(-1).float() for g in grads])
+        dist.all_reduce(flat)
+        flat /= self._world_size
+        offset = 0
+        for g in grads:
+            g.copy_(flat[offset : offset + g.numel()].view_as(g))
+            offset += g.numel()
+
+    def _reduce_metrics(self, means: torch.Tensor) -> torch.Tensor:
+        dist.all_reduce(means)
+        return means / self._world_size
+
+    def _setup_reference_log_probs(
+        self, cfg_checkpointer: DictConfig, cache_dir: str, batch_size: int
+    ) -> torch.Tensor:
+        path = self._reference_log_probs_path(cfg_checkpointer, cache_dir)
+        # all ranks agree on whether to compute before rank zero can write the file
+        cached = torch.tensor([int(os.path.exists(path))], device=self._device)
+        dist.all_reduce(cached, op=dist.ReduceOp.MIN)
+        if cached.item():
+            log.info(f"Loaded reference log-probs from {path}")
+            return load_reference_log_probs(path).to(self._device)
+        log.info("Precomputing reference log-probs over the whole dataset, sharded across ranks.")
+        reference_log_probs = self._compute_sharded_reference_log_probs(batch_size)
+        if self._is_rank_zero:
+            save_reference_log_probs(reference_log_probs, path)
+            log.info(f"Saved reference log-probs to {path}")
+        return reference_log_probs.to(self._device)
+
+    def _compute_sharded_reference_log_probs(self, batch_size: int) -> torch.Tensor:
+        # every rank fills the rows of its strided slice; the other rows are zero, so a
+        # sum gathers the full cache on every rank
+        shard = range(self._rank, len(self._dataset), self._world_size)
+        reference_log_probs = self._compute_reference_log_probs(batch_size, shard)
+        reference_log_probs = reference_log_probs.to(self._device)
+        dist.all_reduce(reference_log_probs)
+        return reference_log_probs.cpu()
+
+    def save_checkpoint(self, epoch: int) -> None:
+        # the adapters are identical on every rank
+        if self._is_rank_zero:
+            super().save_checkpoint(epoch)
+
+    def cleanup(self) -> None:
+        super().cleanup()
+        dist.destroy_process_group()
+
+
+@config.parse
+def recipe_main(cfg: DictConfig) -> None:
+    """
+    Entry point for the data-parallel recipe.
+
+    Configurable parameters are read in the following order:
+        - Parameters specified in config (see available configs through ``tune ls``)
+        - Overwritten by arguments from the command-line
+    """
+    backend = cfg.get("dist_backend", None) or ("gloo" if cfg.device == "cpu" else "nccl")
+    dist.init_process_group(
+        backend=backend, timeout=timedelta(minutes=cfg.get("dist_timeout_minutes", 60))
+    )
+    if dist.get_rank() == 0:
+        config.log_config(recipe_name="LoRADPORecipeDataParallel", cfg=cfg)
+    recipe = LoRADPORecipeDataParallel(cfg=cfg)
+    recipe.setup(cfg=cfg)
+    recipe.train()
+    recipe.cleanup()
+
+
+if __name__ == "__main__":
+    sys.exit(recipe_main())
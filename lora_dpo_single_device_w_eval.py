@@ -4,14 +4,37 @@
 # This source code is licensed under the BSD-style license found in the
 # LICENSE file in the root directory of this source tree.
 
-import csv
-from eval_utils import pc_instruction, pc_questions_txt_file, custom_prompts, eval_pc, eval_custom_prompts
+from eval_utils import chat_instruction, pc_instruction, pc_questions_txt_file, custom_prompts, eval_pc, eval_pc_likelihood, eval_custom_prompts, eval_max_seq_len, load_pc_statements, setup_eval_kv_caches
+from eval_results import COMPASS_FIELDS, SCORE_FIELDS, eval_result_writer
+from sampler import LengthBucketBatchSampler, preference_lengths
+from async_checkpoint import AsyncCheckpointer, snapshot_to_cpu
+from async_eval import AsyncEvaluator
+from merge_on_eval import merged_lora_weights
+from step_metrics import DeviceMetricAccumulator
+from step_timer import PhaseTimer
+from prefetch import DevicePrefetcher
+from chunked_log_probs import chunked_batch_log_probs, conversation_logits_mean
+from shared_prompt import padded_collate_dpo_shared_prompt, shared_prompt_batch_log_probs
+from lazy_checkpoint import (
+    LazyHFCheckpoint,
+    load_resume_state,
+    materialize_meta_tensors,
+    stream_state_dict,
+)
+from reference_cache import (
+    IndexedDataset,
+    load_reference_log_probs,
+    padded_collate_dpo_with_indices,
+    reference_log_probs_path,
+    save_reference_log_probs,
+)
 
+import contextlib
 import sys
 import time
 
 from functools import partial
-from typing import Any, Dict, Optional, Tuple
+from typing import Any, Dict, Optional, Sequence, Tuple, Union
 from warnings import warn
 
 import torch
@@ -19,9 +42,9 @@ from omegaconf import DictConfig, ListConfig
 
 from torch import nn
 from torch.optim import Optimizer
-from torch.utils.data import DataLoader, DistributedSampler
+from torch.utils.data import DataLoader, DistributedSampler, Subset
 from torchtune import config, modules, rlhf, training, utils
-from torchtune.data import CROSS_ENTROPY_IGNORE_IDX, padded_collate_dpo, Message
+from torchtune.data import CROSS_ENTROPY_IGNORE_IDX, padded_collate_dpo
 from torchtune.datasets import ConcatDataset
 from torchtune.modules.peft import (
     disable_adapter,
@@ -33,6 +56,7 @@ from torchtune.modules.peft import (
     validate_missing_and_unexpected_for_lora,
 )
 from torchtune.recipe_interfaces import FTRecipeInterface
+from torchtune.training import DummyProfiler, PROFILER_KEY
 
 from tqdm import tqdm
 
@@ -86,6 +110,10 @@ class LoRADPORecipeSingleDevice(FTRecipeInterface):
     def __init__(self, cfg: DictConfig) -> None:
 
         self._device = utils.get_device(device=cfg.device)
+        # 1 and 0 unless a data-parallel subclass runs this recipe under a process group;
+        # only rank zero evaluates, logs and writes results
+        self._world_size, self._rank = training.get_world_size_and_rank()
+        self._is_rank_zero = self._rank == 0
         # Reduced precision logic
         self._dtype = training.get_dtype(cfg.dtype, device=self._device)
 
@@ -142,6 +170,16 @@ class LoRADPORecipeSingleDevice(FTRecipeInterface):
         self._resume_from_checkpoint = cfg.resume_from_checkpoint
         self._save_adapter_weights_only = cfg.get("save_adapter_weights_only", False)
         self._gradient_accumulation_steps = cfg.gradient_accumulation_steps
+        self._log_probs_chunk_size = cfg.get("log_probs_chunk_size", None)
+        self._shared_prompt = cfg.get("shared_prompt", False)
+        self._lazy_checkpoint_loading = cfg.get("lazy_checkpoint_loading", False)
+        self._async_checkpointer = (
+            AsyncCheckpointer() if cfg.get("async_checkpoint", False) else None
+        )
+        self._precompute_reference_log_probs = cfg.get(
+            "precompute_reference_log_probs", False
+        )
+        self._reference_log_probs = None
         
         ############################# <EVAL> #############################
         # self._template = AlpacaInstructTemplate()
@@ -155,24 +193,43 @@ class LoRADPORecipeSingleDevice(FTRecipeInterface):
         self._custom_prompts = [self.format_instruction(q) for q in self._custom_prompts]
 
         self._pc_num_questions = len(self._pc_questions)
-        self._pc_csv_file = f"{self._output_dir}/pc.csv"
-        self._pc_headers = ['iteration', 'step'] + [f"question_{str(i)}" for i in range(self._pc_num_questions)]
-        with open(self._pc_csv_file, 'w', newline='') as f:
-            writer = csv.writer(f)
-            writer.writerow(self._pc_headers)
-
-        self._custom_prompts_file = f"{self._output_dir}/custom_instrs.csv"
-        headers = ['iteration', 'step'] + \
-            [f"prompt_{str(i)}" for i in range(len(self._custom_prompts))]
-        with open(self._custom_prompts_file, 'w', newline='') as f:
-            writer = csv.writer(f)
-            writer.writerow(headers)
+        # long-format records: iteration, step, question_id, answer, num_tokens, latency_s
+        self._eval_results_format = cfg.get("eval_results_format", "csv")
+        eval_results_flush_every = cfg.get("eval_results_flush_every", 512)
+        # "generate" answers the compass statements in free text, "likelihood" scores the
+        # four answer options of every statement and computes the compass coordinates
+        self._pc_eval_mode = cfg.get("pc_eval_mode", "generate")
+        if self._pc_eval_mode == "likelihood":
+            self._pc_statements = load_pc_statements()
+        elif self._pc_eval_mode != "generate":
+            raise ValueError(
+                f"Unknown pc_eval_mode {self._pc_eval_mode!r}; expected 'generate' or 'likelihood'."
+            )
+        self._pc_writers, self._custom_prompts_writer = [], None
+        if self._is_rank_zero:
+            self._setup_eval_writers(eval_results_flush_every)
         self._eval_freq = cfg.get("eval_freq", 512)
+        self._eval_batch_size = cfg.get("eval_batch_size", 8)
+        self._eval_prefix_cache = cfg.get("eval_prefix_cache", True)
+        self._eval_persistent_kv_cache = cfg.get("eval_persistent_kv_cache", True)
+        self._async_eval = cfg.get("async_eval", False)
+        self._eval_merge_lora = cfg.get("eval_merge_lora", False)
+        self._async_evaluator = None
+        self._draft_model = None
+        self._eval_num_draft_tokens = cfg.get("eval_num_draft_tokens", 4)
         self._max_generated_tokens = 300
         self._temperature = 0.3
         self._top_k = 200
 
         log.info(f"Evaluation frequency: {self._eval_freq}")
+        log.info(f"Evaluation batch size: {self._eval_batch_size}")
+        log.info(f"Evaluation prefix cache: {self._eval_prefix_cache}")
+        log.info(f"Evaluation persistent KV cache: {self._eval_persistent_kv_cache}")
+        log.info(f"Evaluation results format: {self._eval_results_format}")
+        log.info(f"Political compass evaluation mode: {self._pc_eval_mode}")
+        log.info(f"Asynchronous evaluation: {self._async_eval}")
+        log.info(f"Merge LoRA for evaluation: {self._eval_merge_lora}")
+        log.info(f"Speculative eval decoding: {cfg.get('eval_draft_model', None) is not None} ({self._eval_num_draft_tokens} draft tokens)")
         log.info(f"Max generated tokens: {self._max_generated_tokens}")
         log.info(f"Temperature: {self._temperature}")
         log.info(f"Top k: {self._top_k}")
@@ -180,11 +237,36 @@ class LoRADPORecipeSingleDevice(FTRecipeInterface):
     def format_instruction(self, instr, inp=""):
         # return format_instruction(self._template, instr, inp)
         # return convert_instruction_to_llama3(instr, inp)
-        return [Message(role="user", content=f"{instr} {inp}"), 
-                Message(role="assistant", content="")] # WITHOUT PREFILL GIVES EMPTY RESPONSES FOR PC
+        return chat_instruction(instr, inp)
 
     def generate_pc_instruction(self, question):
         return self.format_instruction(self._pc_instruction, question)
+
+    def _setup_eval_writers(self, eval_results_flush_every):
+        if self._pc_eval_mode == "generate":
+            self._pc_writers = [
+                eval_result_writer(
+                    f"{self._output_dir}/pc", self._eval_results_format, eval_results_flush_every
+                )
+            ]
+        else:
+            self._pc_writers = [
+                eval_result_writer(
+                    f"{self._output_dir}/pc_scores",
+                    self._eval_results_format,
+                    eval_results_flush_every,
+                    fields=SCORE_FIELDS,
+                ),
+                eval_result_writer(
+                    f"{self._output_dir}/compass",
+                    self._eval_results_format,
+                    eval_results_flush_every,
+                    fields=COMPASS_FIELDS,
+                ),
+            ]
+        self._custom_prompts_writer = eval_result_writer(
+            f"{self._output_dir}/custom_instrs", self._eval_results_format, eval_results_flush_every
+        )
         ############################# </EVAL> #############################
 
     def load_checkpoint(self, cfg_checkpointer: DictConfig) -> Dict[str, Any]:
@@ -192,12 +274,39 @@ class LoRADPORecipeSingleDevice(FTRecipeInterface):
         Extract the checkpoint state from file and validate. This includes the
         base model weights. If resume_from_checkpoint is True, this also includes
         the adapter weights and recipe state
+
+        With ``lazy_checkpoint_loading`` the base weights are a :class:`~lazy_checkpoint.LazyHFCheckpoint`
+        that is only read when loaded into the model, and the adapter weights and recipe
+        state are memory-mapped.
         """
         self._checkpointer = config.instantiate(
             cfg_checkpointer,
             should_load_recipe_state=self._resume_from_checkpoint,
         )
-        checkpoint_dict = self._checkpointer.load_checkpoint()
+        if self._lazy_checkpoint_loading:
+            base_checkpoint = LazyHFCheckpoint(
+                cfg_checkpointer.checkpoint_dir,
+                list(cfg_checkpointer.checkpoint_files),
+                model_type=cfg_checkpointer.model_type,
+            )
+            # the checkpointer records this while loading and needs it to save merged weights
+            self._checkpointer._weight_map = base_checkpoint.weight_map
+            checkpoint_dict = {training.MODEL_KEY: base_checkpoint}
+            if self._resume_from_checkpoint:
+                # the checkpointer resolved these on construction, falling back to the
+                # latest intermediate checkpoint under its output_dir when not configured
+                adapter_checkpoint = getattr(self._checkpointer, "_adapter_checkpoint", None)
+                recipe_checkpoint = getattr(self._checkpointer, "_recipe_checkpoint", None)
+                if adapter_checkpoint and recipe_checkpoint:
+                    checkpoint_dict.update(
+                        load_resume_state(adapter_checkpoint, recipe_checkpoint)
+                    )
+                else:
+                    resume_dict = self._checkpointer.load_checkpoint()
+                    resume_dict.pop(training.MODEL_KEY, None)
+                    checkpoint_dict.update(resume_dict)
+        else:
+            checkpoint_dict = self._checkpointer.load_checkpoint()
 
         if self._resume_from_checkpoint:
             if training.ADAPTER_KEY not in checkpoint_dict:
@@ -254,10 +363,12 @@ class LoRADPORecipeSingleDevice(FTRecipeInterface):
         Setup the recipe state. This includes recipe state (if resume_from_checkpoint is True),
         model, tokenizer, loss, optimizer, learning rate scheduler, sampler, and dataloader.
         """
-        self._metric_logger = config.instantiate(cfg.metric_logger)
+        self._metric_logger = None
+        if self._is_rank_zero:
+            self._metric_logger = config.instantiate(cfg.metric_logger)
 
-        # log config with parameter override
-        self._metric_logger.log_config(cfg)
+            # log config with parameter override
+            self._metric_logger.log_config(cfg)
 
         self._model_compile = cfg.compile
         checkpoint_dict = self.load_checkpoint(cfg_checkpointer=cfg.checkpointer)
@@ -278,6 +389,19 @@ class LoRADPORecipeSingleDevice(FTRecipeInterface):
         self._tokenizer = config.instantiate(cfg.tokenizer)
         log.info("Tokenizer is initialized from file.")
 
+        if self._async_eval and self._is_rank_zero:
+            self._async_evaluator = AsyncEvaluator(
+                self._setup_eval_model(
+                    cfg_model=cfg.model,
+                    eval_device=torch.device(cfg.get("eval_device", None) or "cpu"),
+                    base_model_state_dict=checkpoint_dict[training.MODEL_KEY],
+                ),
+                eval_fn=self._run_evals,
+            )
+
+        if self._is_rank_zero:
+            self._setup_eval_decoding(cfg)
+
         self._optimizer = self._setup_optimizer(
             cfg_optimizer=cfg.optimizer,
             opt_state_dict=(
@@ -290,14 +414,33 @@ class LoRADPORecipeSingleDevice(FTRecipeInterface):
         self._loss_fn = config.instantiate(cfg.loss)
         log.info("Loss function is initialized.")
 
+        self._phase_timer = PhaseTimer(
+            self._device, enabled=cfg.get("log_phase_times", False)
+        )
+        self._profiler = self._setup_profiler(cfg.get(PROFILER_KEY, None))
+
         # Dataloader depends on the tokenizer and loss_fn and should be
         # setup after all of these are setup
         self._sampler, self._dataloader = self._setup_data(
             cfg_dataset=cfg.dataset,
             shuffle=cfg.shuffle,
             batch_size=cfg.batch_size,
+            length_bucketing=cfg.get("length_bucketing", False),
+            num_workers=cfg.get("num_workers", 0),
+            prefetch_to_device=cfg.get("prefetch_to_device", False),
         )
 
+        # The reference log-probs only depend on the frozen base model and the data, so
+        # they can be computed once and reused by every epoch (and every run sharing them)
+        if self._precompute_reference_log_probs:
+            self._reference_log_probs = self._setup_reference_log_probs(
+                cfg_checkpointer=cfg.checkpointer,
+                cache_dir=cfg.get(
+                    "reference_log_probs_dir", f"{self._output_dir}/reference_log_probs"
+                ),
+                batch_size=cfg.batch_size,
+            )
+
         # Finally update the recipe state which can only be correctly set after all of the
         # other components have been initialized and updated.
 
@@ -323,6 +466,41 @@ class LoRADPORecipeSingleDevice(FTRecipeInterface):
             last_epoch=self.global_step - 1,
         )
 
+    def _setup_profiler(
+        self, cfg_profiler: Optional[DictConfig] = None
+    ) -> Union[torch.profiler.profile, DummyProfiler]:
+        """
+        Parses the `profiler` section of top-level `cfg` and sets up profiler. The trace
+        window is set by ``wait_steps``, ``warmup_steps`` and ``active_steps``, counted in
+        batches; traces are written to ``output_dir``.
+
+        Args:
+            cfg_profiler (Optional[DictConfig]): ``profiler`` section of the top-level ``cfg`` (the main config passed to
+                `recipe.main`). Default None.
+
+        Returns:
+            profiler: Union[torch.profiler.profile, DummyProfiler] - DummyProfiler is a nullcontext with no-op methods
+            for `start`, `stop`, and `step` that can be used in place of `torch.profiler.profile` if profiler is not enabled such
+            that the instrumented training loop does not need to be changed profiling is disabled.
+        """
+        # Missing profiler section in config, assume disabled
+        if cfg_profiler is None:
+            cfg_profiler = DictConfig({"enabled": False})
+
+        # Check that component is included and set correctly
+        if cfg_profiler.get("_component_", None) is None:
+            cfg_profiler["_component_"] = "torchtune.training.setup_torch_profiler"
+        else:
+            assert (
+                cfg_profiler.get("_component_")
+                == "torchtune.training.setup_torch_profiler"
+            ), "Only torch profiler supported currently: component must be `torchtune.training.setup_torch_profiler`"
+
+        profiler, profiler_cfg = config.instantiate(cfg_profiler)
+
+        log.info(f" Profiler config after instantiation: {profiler_cfg}")
+        return profiler
+
     def _setup_model(
         self,
         cfg_model: DictConfig,
@@ -332,7 +510,11 @@ class LoRADPORecipeSingleDevice(FTRecipeInterface):
         base_model_state_dict: Dict[str, Any],
         lora_weights_state_dict: Optional[Dict[str, Any]] = None,
     ) -> nn.Module:
-        with training.set_default_dtype(self._dtype), self._device:
+        lazy = isinstance(base_model_state_dict, LazyHFCheckpoint)
+        # a lazily loaded model starts on the meta device and gets its weights in place
+        with training.set_default_dtype(self._dtype), (
+            torch.device("meta") if lazy else self._device
+        ):
             model = config.instantiate(cfg_model)
         self._lora_rank = cfg_model.lora_rank
         self._lora_alpha = cfg_model.lora_alpha
@@ -347,15 +529,33 @@ class LoRADPORecipeSingleDevice(FTRecipeInterface):
                 model, auto_wrap_policy={modules.TransformerSelfAttentionLayer}
             )
 
-        base_missing, base_unexpected = model.load_state_dict(
-            base_model_state_dict, strict=False
-        )
-        if lora_weights_state_dict:
-            lora_missing, lora_unexpected = model.load_state_dict(
-                lora_weights_state_dict, strict=False
+        if lazy:
+            base_missing, base_unexpected = base_model_state_dict.load_into(
+                model, self._device
+            )
+        else:
+            base_missing, base_unexpected = model.load_state_dict(
+                base_model_state_dict, strict=False
             )
+        if lora_weights_state_dict:
+            if lazy:
+                lora_missing, lora_unexpected = stream_state_dict(
+                    model, lora_weights_state_dict.items(), self._device
+                )
+            else:
+                lora_missing, lora_unexpected = model.load_state_dict(
+                    lora_weights_state_dict, strict=False
+                )
         else:
             lora_missing, lora_unexpected = None, None
+        if lazy:
+            materialize_meta_tensors(
+                model, self._device, init_adapters=not lora_weights_state_dict
+            )
+            # assigning the weights and materializing replaced the meta parameters, so
+            # the adapter parameters collected above are stale
+            self.adapter_params = get_adapter_params(model)
+            set_trainable_params(model, self.adapter_params)
         validate_missing_and_unexpected_for_lora(
             lora_attn_modules=self._lora_attn_modules,
             apply_lora_to_mlp=self._apply_lora_to_mlp,
@@ -418,11 +618,25 @@ class LoRADPORecipeSingleDevice(FTRecipeInterface):
         cfg_dataset: DictConfig,
         shuffle: bool,
         batch_size: int,
-    ) -> Tuple[DistributedSampler, DataLoader]:
+        length_bucketing: bool = False,
+        num_workers: int = 0,
+        prefetch_to_device: bool = False,
+    ) -> Tuple[
+        Union[DistributedSampler, LengthBucketBatchSampler],
+        Union[DataLoader, DevicePrefetcher],
+    ]:
         """
         All data related setup happens here. Currently this recipe only supports
         Map-style Datasets which fit into memory and an option for random shuffling.
-        Samplers, iterable datasets, and streaming datasets are not supported.
+        Iterable datasets and streaming datasets are not supported.
+
+        If ``length_bucketing`` is True, batches are drawn by a
+        :class:`~sampler.LengthBucketBatchSampler` which groups preference pairs of similar
+        length to reduce the padding added by ``padded_collate_dpo``.
+
+        Batches are collated by ``num_workers`` worker processes. With ``prefetch_to_device``
+        they are collated into pinned memory and the next batch is copied to the device on a
+        side stream while the current step runs.
         """
         if isinstance(cfg_dataset, ListConfig):
             datasets = [
@@ -432,36 +646,227 @@ class LoRADPORecipeSingleDevice(FTRecipeInterface):
             ds = ConcatDataset(datasets=datasets)
         else:
             ds = config.instantiate(cfg_dataset, tokenizer=self._tokenizer)
+        self._dataset = ds
+        # the shared-prompt layout packs each pair into one row instead of two
+        self._collate_fn = (
+            padded_collate_dpo_shared_prompt if self._shared_prompt else padded_collate_dpo
+        )
+
+        if self._precompute_reference_log_probs:
+            # batches also carry dataset indices to look up the cached reference log-probs
+            ds = IndexedDataset(ds)
+            collate_fn = partial(
+                padded_collate_dpo_with_indices,
+                padding_idx=self._tokenizer.pad_id,
+                ignore_idx=CROSS_ENTROPY_IGNORE_IDX,
+                collate_fn=self._collate_fn,
+            )
+        else:
+            collate_fn = partial(
+                self._collate_fn,
+                padding_idx=self._tokenizer.pad_id,
+                ignore_idx=CROSS_ENTROPY_IGNORE_IDX,
+            )
+        loader_kwargs = dict(
+            collate_fn=collate_fn,
+            num_workers=num_workers,
+            pin_memory=prefetch_to_device and self._device.type == "cuda",
+            persistent_workers=num_workers > 0,
+        )
+        if length_bucketing:
+            sampler = LengthBucketBatchSampler(
+                preference_lengths(ds),
+                batch_size=batch_size,
+                num_replicas=self._world_size,
+                rank=self._rank,
+                shuffle=shuffle,
+                seed=0,
+                # dropping last avoids shape issues with compile + flex attention
+                drop_last=True,
+            )
+            dataloader = DataLoader(
+                dataset=ds,
+                batch_sampler=sampler,
+                **loader_kwargs,
+            )
+        else:
+            sampler = DistributedSampler(
+                ds,
+                num_replicas=self._world_size,
+                rank=self._rank,
+                shuffle=shuffle,
+                seed=0,
+            )
+            dataloader = DataLoader(
+                dataset=ds,
+                sampler=sampler,
+                batch_size=batch_size,
+                # dropping last avoids shape issues with compile + flex attention
+                drop_last=True,
+                **loader_kwargs,
+            )
+        if prefetch_to_device:
+            dataloader = DevicePrefetcher(dataloader, self._device)
+        log.info("Dataset and Sampler are initialized.")
+
+        return sampler, dataloader
 
-        sampler = DistributedSampler(
-            ds,
-            num_replicas=1,
-            rank=0,
-            shuffle=shuffle,
-            seed=0,
+    def _setup_reference_log_probs(
+        self, cfg_checkpointer: DictConfig, cache_dir: str, batch_size: int
+    ) -> torch.Tensor:
+        """
+        Load the reference-model log-probs of every example in the dataset from
+        ``cache_dir``, computing and saving them first if no cache file exists for this
+        base checkpoint and dataset. Returns a ``[num_examples, 2]`` tensor on device
+        holding the chosen and rejected log-probs.
+        """
+        path = self._reference_log_probs_path(cfg_checkpointer, cache_dir)
+        try:
+            reference_log_probs = load_reference_log_probs(path)
+            log.info(f"Loaded reference log-probs from {path}")
+        except FileNotFoundError:
+            log.info("Precomputing reference log-probs over the whole dataset.")
+            reference_log_probs = self._compute_reference_log_probs(batch_size)
+            save_reference_log_probs(reference_log_probs, path)
+            log.info(f"Saved reference log-probs to {path}")
+        return reference_log_probs.to(self._device)
+
+    def _reference_log_probs_path(self, cfg_checkpointer: DictConfig, cache_dir: str) -> str:
+        return reference_log_probs_path(
+            cache_dir,
+            self._dataset,
+            checkpoint_dir=cfg_checkpointer.checkpoint_dir,
+            checkpoint_files=list(cfg_checkpointer.checkpoint_files),
+            dtype=self._dtype,
         )
+
+    def _compute_reference_log_probs(
+        self, batch_size: int, shard: Optional[Sequence[int]] = None
+    ) -> torch.Tensor:
+        """
+        Reference log-probs of the examples at the indices in ``shard`` (all of them by default), in a
+        ``[num_examples, 2]`` tensor that is zero for every other example.
+        """
+        ds = IndexedDataset(self._dataset)
         dataloader = DataLoader(
-            dataset=ds,
-            sampler=sampler,
+            dataset=ds if shard is None else Subset(ds, shard),
             batch_size=batch_size,
-            # dropping last avoids shape issues with compile + flex attention
-            drop_last=True,
+            shuffle=False,
             collate_fn=partial(
-                padded_collate_dpo,
+                padded_collate_dpo_with_indices,
                 padding_idx=self._tokenizer.pad_id,
                 ignore_idx=CROSS_ENTROPY_IGNORE_IDX,
+                collate_fn=self._collate_fn,
             ),
         )
-        log.info("Dataset and Sampler are initialized.")
-
-        return sampler, dataloader
+        reference_log_probs = torch.zeros(len(self._dataset), 2, dtype=torch.float32)
+        with torch.no_grad(), disable_adapter(self._model):
+            for batch in tqdm(dataloader, disable=not self._is_rank_zero):
+                batch, indices = batch[:-1], batch[-1]
+                chosen_log_probs, rejected_log_probs, _, _ = self.concatenated_forward(
+                    self._model, batch
+                )
+                reference_log_probs[indices, 0] = chosen_log_probs.float().cpu()
+                reference_log_probs[indices, 1] = rejected_log_probs.float().cpu()
+        return reference_log_probs
     
     ############################# <EVAL> #############################
-    def eval_pc(self, iteration=0, step=0):
-        return eval_pc(pc_questions=self._pc_questions, pc_csv_file=self._pc_csv_file, log=log, model=self._model, tokenizer=self._tokenizer, max_generated_tokens=self._max_generated_tokens, temperature=self._temperature, top_k=self._top_k, iteration=iteration, step=step)
+    def _setup_eval_model(
+        self,
+        cfg_model: DictConfig,
+        eval_device: torch.device,
+        base_model_state_dict: Dict[str, Any],
+    ) -> nn.Module:
+        """
+        Build the copy of the model used by async eval on ``eval_device``. Only the base
+        weights are loaded here; every eval loads the adapter snapshot it was given.
+        """
+        lazy = isinstance(base_model_state_dict, LazyHFCheckpoint)
+        with training.set_default_dtype(self._dtype), (
+            torch.device("meta") if lazy else eval_device
+        ):
+            model = config.instantiate(cfg_model)
+        if lazy:
+            base_model_state_dict.load_into(model, eval_device)
+            materialize_meta_tensors(model, eval_device)
+        else:
+            model.load_state_dict(base_model_state_dict, strict=False)
+        model.requires_grad_(False)
+        model.eval()
+        log.info(f"Async eval model is initialized on {eval_device}.")
+        return model
+
+    def _setup_eval_decoding(self, cfg: DictConfig) -> None:
+        """
+        Load the draft model for speculative eval decoding, if configured, and set up the
+        persistent eval KV caches of the eval model and the draft.
+        """
+        eval_model = (
+            self._async_evaluator.model if self._async_evaluator is not None else self._model
+        )
+        if cfg.get("eval_draft_model", None) is not None:
+            # proposes tokens for speculative eval decoding, next to the model it drafts for
+            self._draft_model = self._setup_draft_model(
+                cfg_draft_model=cfg.eval_draft_model,
+                cfg_draft_checkpointer=cfg.eval_draft_checkpointer,
+                device=eval_model.tok_embeddings.weight.device,
+            )
+
+        if self._eval_persistent_kv_cache:
+            # sized for the longest eval prompt so every eval pass reuses the same caches;
+            # speculative decoding scores up to num_draft_tokens positions past the answer
+            decoder_max_seq_len = eval_max_seq_len(
+                self._tokenizer,
+                self._pc_questions + self._custom_prompts,
+                self._max_generated_tokens
+                + (self._eval_num_draft_tokens if self._draft_model is not None else 0),
+            )
+            for model in (eval_model, self._draft_model):
+                if model is not None:
+                    setup_eval_kv_caches(
+                        model,
+                        batch_size=self._eval_batch_size,
+                        decoder_max_seq_len=decoder_max_seq_len,
+                    )
+            log.info("Eval KV caches are initialized.")
+
+    def _setup_draft_model(
+        self,
+        cfg_draft_model: DictConfig,
+        cfg_draft_checkpointer: DictConfig,
+        device: torch.device,
+    ) -> nn.Module:
+        """
+        Build the draft model for speculative eval decoding on ``device`` and load its
+        weights. It must share the policy's tokenizer.
+        """
+        with training.set_default_dtype(self._dtype), device:
+            model = config.instantiate(cfg_draft_model)
+        checkpointer = config.instantiate(cfg_draft_checkpointer)
+        model.load_state_dict(checkpointer.load_checkpoint()[training.MODEL_KEY])
+        model.requires_grad_(False)
+        model.eval()
+        log.info(f"Draft model for speculative eval decoding is initialized on {device}.")
+        return model
 
-    def eval_custom_prompts(self, iteration=0, step=0):
-        return eval_custom_prompts(custom_prompts=self._custom_prompts, custom_prompts_file=self._custom_prompts_file, log=log, model=self._model, tokenizer=self._tokenizer, max_generated_tokens=self._max_generated_tokens, temperature=self._temperature, top_k=self._top_k, iteration=iteration, step=step)
+    def _run_evals(self, model, iteration=0, step=0):
+        # generation runs the plain base matmuls; the unmerged weights are restored bitwise
+        if self._eval_merge_lora and model is self._model and self._async_checkpointer is not None:
+            # a pending save reads the base weights on its worker thread, which must not
+            # see them half merged
+            self._async_checkpointer.wait()
+        with merged_lora_weights(model) if self._eval_merge_lora else contextlib.nullcontext():
+            self.eval_custom_prompts(iteration=iteration, step=step, model=model)
+            self.eval_pc(iteration=iteration, step=step, model=model)
+
+    def eval_pc(self, iteration=0, step=0, model=None):
+        if self._pc_eval_mode == "likelihood":
+            pc_scores_writer, compass_writer = self._pc_writers
+            return eval_pc_likelihood(pc_statements=self._pc_statements, pc_scores_writer=pc_scores_writer, compass_writer=compass_writer, log=log, model=model if model is not None else self._model, tokenizer=self._tokenizer, iteration=iteration, step=step, batch_size=self._eval_batch_size)
+        return eval_pc(pc_questions=self._pc_questions, pc_writer=self._pc_writers[0], log=log, model=model if model is not None else self._model, tokenizer=self._tokenizer, max_generated_tokens=self._max_generated_tokens, temperature=self._temperature, top_k=self._top_k, iteration=iteration, step=step, batch_size=self._eval_batch_size, prefix_cache=self._eval_prefix_cache, draft_model=self._draft_model, num_draft_tokens=self._eval_num_draft_tokens)
+
+    def eval_custom_prompts(self, iteration=0, step=0, model=None):
+        return eval_custom_prompts(custom_prompts=self._custom_prompts, custom_prompts_writer=self._custom_prompts_writer, log=log, model=model if model is not None else self._model, tokenizer=self._tokenizer, max_generated_tokens=self._max_generated_tokens, temperature=self._temperature, top_k=self._top_k, iteration=iteration, step=step, batch_size=self._eval_batch_size, prefix_cache=self._eval_prefix_cache, draft_model=self._draft_model, num_draft_tokens=self._eval_num_draft_tokens)
     ############################# </EVAL> #############################
 
     def save_checkpoint(self, epoch: int) -> None:
@@ -474,6 +879,9 @@ class LoRADPORecipeSingleDevice(FTRecipeInterface):
         - If the `self._save_adapter_weights_only` option is True, the checkpointer will save only the adapter weights
 
         To correctly resume from training, the adapter weights and recipe state must be provided along with the base model weights.
+
+        If ``async_checkpoint`` is enabled, the adapter and optimizer state are copied to CPU
+        here and the LoRA merge and write happen on a background thread.
         """
         ckpt_dict = {}
 
@@ -492,11 +900,46 @@ class LoRADPORecipeSingleDevice(FTRecipeInterface):
 
         adapter_state_dict = get_adapter_state_dict(self._model.state_dict())
         ckpt_dict.update({training.ADAPTER_KEY: adapter_state_dict})
+
+        adapter_config = {
+            "r": self._lora_rank,
+            "lora_alpha": self._lora_alpha,
+            "target_modules": get_lora_module_names(
+                self._lora_attn_modules,
+                self._apply_lora_to_mlp,
+                self._apply_lora_to_output,
+            ),
+            "peft_type": "LORA",
+        }
+        ckpt_dict.update({training.ADAPTER_CONFIG: adapter_config})
+
+        if self._async_checkpointer is None:
+            self._write_checkpoint(ckpt_dict, epoch, intermediate_checkpoint)
+        else:
+            # the adapter and optimizer keep changing once the next epoch starts, so they
+            # are copied now; the base weights are read by the worker, and evals wait for
+            # it before merging the adapters into them
+            self._async_checkpointer.submit(
+                self._write_checkpoint,
+                snapshot_to_cpu(ckpt_dict),
+                epoch,
+                intermediate_checkpoint,
+            )
+
+    def _write_checkpoint(
+        self, ckpt_dict: Dict[str, Any], epoch: int, intermediate_checkpoint: bool
+    ) -> None:
+        """
+        Merge the adapter in ``ckpt_dict`` into the base weights (unless only adapter
+        weights are saved) and write the checkpoint.
+        """
         if not self._save_adapter_weights_only:
             # Construct the full state dict with LoRA weights merged into base LLM weights
 
             # Move to CPU to avoid a copy on GPU
             state_dict = {k: v.cpu() for k, v in self._model.state_dict().items()}
+            # merge the adapter being checkpointed, which may be older than the live one
+            state_dict.update(ckpt_dict[training.ADAPTER_KEY])
 
             merged_state_dict = get_merged_lora_ckpt(
                 state_dict,
@@ -506,18 +949,6 @@ class LoRADPORecipeSingleDevice(FTRecipeInterface):
 
             ckpt_dict.update({training.MODEL_KEY: merged_state_dict})
 
-        adapter_config = {
-            "r": self._lora_rank,
-            "lora_alpha": self._lora_alpha,
-            "target_modules": get_lora_module_names(
-                self._lora_attn_modules,
-                self._apply_lora_to_mlp,
-                self._apply_lora_to_output,
-            ),
-            "peft_type": "LORA",
-        }
-        ckpt_dict.update({training.ADAPTER_CONFIG: adapter_config})
-
         self._checkpointer.save_checkpoint(
             ckpt_dict,
             epoch=epoch,
@@ -531,13 +962,26 @@ class LoRADPORecipeSingleDevice(FTRecipeInterface):
         """
         Run forward pass of the model with chosen and rejected samples concatenated.
 
+        If ``log_probs_chunk_size`` is set, the output projection is applied to that many
+        positions at a time so the full logits are never materialized. With ``shared_prompt``
+        the batch is in the layout of :func:`~shared_prompt.padded_collate_dpo_shared_prompt`
+        and each pair's prompt is encoded once.
+
         Args:
             model (nn.Module): The model to be used for the forward pass.
             batch (Tuple[torch.Tensor, torch.Tensor]): Tuple of input_ids and labels.
 
         Returns:
-            Tuple of chosen log probs, rejected log probs, chosen logits, rejected logits.
+            Tuple of chosen log probs, rejected log probs, and the (detached) means of the
+            chosen and rejected logits.
         """
+        if self._shared_prompt:
+            batch = tuple(t.to(self._device) for t in batch)
+            with self.activations_handling_ctx:
+                return shared_prompt_batch_log_probs(
+                    model, batch, chunk_size=self._log_probs_chunk_size
+                )
+
         concatenated_input_ids, concatenated_labels = batch
         concatenated_input_ids = concatenated_input_ids.to(self._device)
         concatenated_labels = concatenated_labels.to(self._device)
@@ -545,18 +989,33 @@ class LoRADPORecipeSingleDevice(FTRecipeInterface):
         # formed by concatenating an equal number of "chosen" and "rejected".
         len_chosen = concatenated_input_ids.shape[0] // 2
 
-        with self.activations_handling_ctx:
-            all_logits = model(concatenated_input_ids)
+        if self._log_probs_chunk_size is not None:
+            with self.activations_handling_ctx:
+                all_log_probs, position_logit_means = chunked_batch_log_probs(
+                    model,
+                    concatenated_input_ids,
+                    concatenated_labels,
+                    chunk_size=self._log_probs_chunk_size,
+                )
+        else:
+            with self.activations_handling_ctx:
+                all_logits = model(concatenated_input_ids)
+
+            all_log_probs = rlhf.get_batch_log_probs(all_logits, concatenated_labels)
+            position_logit_means = all_logits.detach().mean(-1)
 
-        all_log_probs = rlhf.get_batch_log_probs(all_logits, concatenated_labels)
+        # averaged over the conversations' positions, without padding, in every path
+        chosen_logits_mean = conversation_logits_mean(
+            position_logit_means[:len_chosen], concatenated_labels[:len_chosen]
+        )
+        rejected_logits_mean = conversation_logits_mean(
+            position_logit_means[len_chosen:], concatenated_labels[len_chosen:]
+        )
 
         chosen_log_probs = all_log_probs[:len_chosen]
         rejected_log_probs = all_log_probs[len_chosen:]
 
-        chosen_logits = all_logits[:len_chosen]
-        rejected_logits = all_logits[len_chosen:]
-
-        return (chosen_log_probs, rejected_log_probs, chosen_logits, rejected_logits)
+        return (chosen_log_probs, rejected_log_probs, chosen_logits_mean, rejected_logits_mean)
 
     def train(self) -> None:
         """
@@ -567,18 +1026,22 @@ class LoRADPORecipeSingleDevice(FTRecipeInterface):
                 "NOTE: torch.compile is enabled and model is compiled in first forward. Expect a relatively slow first iteration."
             )
 
-        # Initialize tokens count and running loss (for grad accumulation)
+        # Initialize tokens count; loss and reward metrics are accumulated on device
         t0 = time.perf_counter()
-        running_loss = 0
         num_tokens = 0
+        timer = self._phase_timer
+        metrics = DeviceMetricAccumulator(self._device, reduce_fn=self._reduce_metrics)
 
+        self._profiler.start()
         # self.epochs_run should be non-zero when we're resuming from a checkpoint
         for curr_epoch in range(self.epochs_run, self.total_epochs):
             # Update the sampler to ensure data is correctly shuffled across epochs
             # in case shuffle is True
             self._sampler.set_epoch(curr_epoch)
-            pbar = tqdm(total=self._steps_per_epoch)
+            pbar = tqdm(total=self._steps_per_epoch, disable=not self._is_rank_zero)
+            timer.start("data")
             for idx, batch in enumerate(self._dataloader):
+                timer.stop("data")
                 if (
                     self.max_steps_per_epoch is not None
                     and (idx // self._gradient_accumulation_steps)
@@ -587,10 +1050,18 @@ class LoRADPORecipeSingleDevice(FTRecipeInterface):
                     break
                 
                 ############################# <EVAL> #############################
-                if idx % self._eval_freq == 0:
-                    # Print the first training input decoded
-                    self.eval_custom_prompts(iteration=curr_epoch, step=idx)
-                    self.eval_pc(iteration=curr_epoch, step=idx)
+                if self._is_rank_zero and idx % self._eval_freq == 0:
+                    timer.start("eval")
+                    if self._async_evaluator is not None:
+                        # only the adapter is snapshotted; generation runs on the eval device
+                        self._async_evaluator.submit(
+                            get_adapter_state_dict(self._model.state_dict(), device=None),
+                            iteration=curr_epoch,
+                            step=idx,
+                        )
+                    else:
+                        self._run_evals(self._model, iteration=curr_epoch, step=idx)
+                    timer.stop("eval")
                     # log.info(
                     #     f"Saving checkpoint at {curr_epoch}_{str(idx).zfill(4)}")
                     # self.save_checkpoint(
@@ -598,28 +1069,32 @@ class LoRADPORecipeSingleDevice(FTRecipeInterface):
                     # sys.stdout.flush()
                 ############################# </EVAL> #############################
                 
-                # batch is input_ids, labels
+                # batch is input_ids, labels (or the shared-prompt tensors), and with precomputed
+                # reference log-probs the dataset indices as the last element
+                if self._reference_log_probs is not None:
+                    batch, indices = batch[:-1], batch[-1]
                 num_tokens += batch[0].numel()
-                (
-                    policy_chosen_log_probs,
-                    policy_rejected_log_probs,
-                    policy_chosen_logits,
-                    policy_rejected_logits,
-                ) = self.concatenated_forward(self._model, batch)
-
-                policy_chosen_logits_mean = policy_chosen_logits.detach().mean()
-                policy_rejected_logits_mean = policy_rejected_logits.detach().mean()
-
-                # deleting logits here helps reduce (peak) memory usage - we only need them for metric logging
-                del policy_chosen_logits, policy_rejected_logits
-
-                with torch.no_grad(), disable_adapter(self._model):
+                with timer.phase("policy_forward"):
+                    # only the logit means are returned: the logits are needed for metric logging alone
                     (
-                        reference_chosen_log_probs,
-                        reference_rejected_log_probs,
-                        _,
-                        _,
+                        policy_chosen_log_probs,
+                        policy_rejected_log_probs,
+                        policy_chosen_logits_mean,
+                        policy_rejected_logits_mean,
                     ) = self.concatenated_forward(self._model, batch)
+
+                if self._reference_log_probs is not None:
+                    indices = indices.to(self._device)
+                    reference_chosen_log_probs = self._reference_log_probs[indices, 0]
+                    reference_rejected_log_probs = self._reference_log_probs[indices, 1]
+                else:
+                    with timer.phase("reference_forward"), torch.no_grad(), disable_adapter(self._model):
+                        (
+                            reference_chosen_log_probs,
+                            reference_rejected_log_probs,
+                            _,
+                            _,
+                        ) = self.concatenated_forward(self._model, batch)
                 loss, chosen_rewards, rejected_rewards = self._loss_fn(
                     policy_chosen_log_probs,
                     policy_rejected_log_probs,
@@ -629,68 +1104,121 @@ class LoRADPORecipeSingleDevice(FTRecipeInterface):
 
                 loss = loss.mean()
                 reward_accuracies = (chosen_rewards > rejected_rewards).float()
+                # averaged over every micro-batch until the next log step
+                metrics.add(
+                    {
+                        "loss": loss.detach(),
+                        "rewards/chosen": chosen_rewards.detach().mean(),
+                        "rewards/rejected": rejected_rewards.detach().mean(),
+                        "rewards/accuracies": reward_accuracies.mean(),
+                        "rewards/margins": (chosen_rewards - rejected_rewards)
+                        .detach()
+                        .mean(),
+                        "log_probs/rejected": policy_rejected_log_probs.detach().mean(),
+                        "log_probs/chosen": policy_chosen_log_probs.detach().mean(),
+                        "logits/rejected": policy_rejected_logits_mean,
+                        "logits/chosen": policy_chosen_logits_mean,
+                    }
+                )
 
                 loss = loss / self._gradient_accumulation_steps
-                running_loss += loss
-                loss.backward()
+                with timer.phase("backward"):
+                    loss.backward()
 
                 # Step with optimizer
                 if (idx + 1) % self._gradient_accumulation_steps == 0:
-                    self._optimizer.step()
-                    self._optimizer.zero_grad(set_to_none=True)
+                    with timer.phase("optimizer"):
+                        self._reduce_gradients()
+                        self._optimizer.step()
+                        self._optimizer.zero_grad(set_to_none=True)
 
-                    if self._lr_scheduler is not None:
-                        self._lr_scheduler.step()
+                        if self._lr_scheduler is not None:
+                            self._lr_scheduler.step()
                     # Update the number of steps when the weights are updated
                     self.global_step += 1
 
-                    loss_to_log = running_loss.item()
                     pbar.update(1)
-                    pbar.set_description(
-                        f"{curr_epoch + 1}|{self.global_step}|Loss: {loss_to_log}"
-                    )
 
                     # Log per-step metrics
                     if self.global_step % self._log_every_n_steps == 0:
                         time_per_step = time.perf_counter() - t0
-                        log_dict = {
-                            "loss": loss_to_log,
+                        host_metrics = {
                             "lr": self._optimizer.param_groups[0]["lr"],
                             "tokens_per_second_per_gpu": num_tokens / time_per_step,
-                            "rewards/chosen": chosen_rewards.mean().cpu(),
-                            "rewards/rejected": rejected_rewards.mean().cpu(),
-                            "rewards/accuracies": reward_accuracies.mean().cpu(),
-                            "rewards/margins": (chosen_rewards - rejected_rewards)
-                            .mean()
-                            .cpu(),
-                            "log_probs/rejected": policy_rejected_log_probs.detach()
-                            .mean()
-                            .cpu(),
-                            "log_probs/chosen": policy_chosen_log_probs.detach()
-                            .mean()
-                            .cpu(),
-                            "logits/rejected": policy_rejected_logits_mean.cpu(),
-                            "logits/chosen": policy_chosen_logits_mean.cpu(),
                         }
                         if self._log_peak_memory_stats:
-                            log_dict.update(
+                            host_metrics.update(
                                 training.get_memory_stats(device=self._device)
                             )
-                        self._metric_logger.log_dict(
-                            log_dict,
-                            step=self.global_step,
-                        )
+                        if timer.enabled:
+                            host_metrics.update(timer.pop(num_steps=self._log_every_n_steps))
+                        # the previous log step's metrics have had a whole interval to reach
+                        # the host, so reading them now does not wait on the device
+                        self._log_metrics(metrics.collect(), pbar, curr_epoch)
+                        metrics.flush(self.global_step, host_metrics)
 
                     # Reset running stats for the next step
-                    running_loss = 0
                     num_tokens = 0
                     t0 = time.perf_counter()
 
+                # Step the profiler once per batch
+                self._profiler.step()
+                timer.start("data")
+
+            timer.stop("data")
+            # the steps since the last log step would otherwise never be logged
+            self._flush_metrics(metrics, pbar, curr_epoch)
             self.epochs_run += 1
             self.save_checkpoint(epoch=curr_epoch)
 
+        self._profiler.stop()
+        self._flush_metrics(metrics)
+
+    def _log_metrics(
+        self,
+        collected: Optional[Tuple[int, Dict[str, float]]],
+        pbar: Optional[tqdm] = None,
+        curr_epoch: int = 0,
+    ) -> None:
+        """Log metrics collected from a :class:`~step_metrics.DeviceMetricAccumulator` against the step they belong to."""
+        if collected is None or self._metric_logger is None:
+            return
+        step, log_dict = collected
+        if pbar is not None:
+            pbar.set_description(f"{curr_epoch + 1}|{step}|Loss: {log_dict['loss']}")
+        self._metric_logger.log_dict(log_dict, step=step)
+
+    def _flush_metrics(
+        self,
+        metrics: DeviceMetricAccumulator,
+        pbar: Optional[tqdm] = None,
+        curr_epoch: int = 0,
+    ) -> None:
+        """Log the pending and the not yet flushed metrics of ``metrics`` now, waiting for the device."""
+        self._log_metrics(metrics.collect(), pbar, curr_epoch)
+        metrics.flush(self.global_step)
+        self._log_metrics(metrics.collect(), pbar, curr_epoch)
+
+    def _reduce_gradients(self) -> None:
+        """Combine the adapter gradients of all processes before the optimizer step; a no-op on a single device."""
+
+    def _reduce_metrics(self, means: torch.Tensor) -> torch.Tensor:
+        """Combine the stacked metric means of all processes; the identity on a single device."""
+        return means
+
     def cleanup(self) -> None:
-        self._metric_logger.close()
+        if self._async_evaluator is not None:
+            # let the last eval write its results before the writers are closed
+            self._async_evaluator.close()
+        if self._async_checkpointer is not None:
+            # wait for the last checkpoints to be written before exiting
+            self._async_checkpointer.close()
+        for writer in self._pc_writers:
+            writer.close()
+        if self._custom_prompts_writer is not None:
+            self._custom_prompts_writer.close()
+        if self._metric_logger is not None:
+            self._metric_logger.close()
 
 
 @config.parse
@@ -0,0 +1,114 @@
+import argparse
+import json
+import os
+import shutil
+from typing import Dict
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+from tqdm import tqdm
+
+'''
+Offline LoRA merge for checkpoints saved with save_adapter_weights_only=True.
+
+Reads the PEFT-format adapter written next to every epoch checkpoint
+(adapter_model.safetensors or adapter_model.bin, plus adapter_config.json), then streams
+the base model's safetensors shards one tensor at a time, folding W += (alpha / r) * B @ A
+into every adapted weight. Each merged shard is written under the same name as its base
+shard, so the base model.safetensors.index.json stays valid. At most one shard is held in
+memory at a time.
+
+    python merge_lora.py --base-dir checkpoints/Llama-3.1-8B-Instruct \
+        --adapter-dir checkpoints/epoch_3 --output-dir checkpoints/epoch_3_merged
+'''
+
+PEFT_PREFIX = "base_model.model."
+
+
+def load_adapter(adapter_dir: str) -> Dict[str, torch.Tensor]:
+    safetensors_path = os.path.join(adapter_dir, "adapter_model.safetensors")
+    if os.path.exists(safetensors_path):
+        with safe_open(safetensors_path, framework="pt") as f:
+            return {key: f.get_tensor(key) for key in f.keys()}
+    bin_path = os.path.join(adapter_dir, "adapter_model.bin")
+    if os.path.exists(bin_path):
+        return torch.load(bin_path, map_location="cpu", weights_only=True)
+    raise FileNotFoundError(
+        f"No adapter_model.safetensors or adapter_model.bin found in {adapter_dir}"
+    )
+
+
+def lora_pairs(adapter: Dict[str, torch.Tensor]) -> Dict[str, tuple]:
+    """Map each adapted base weight name (HF format) to its ``(lora_A, lora_B)`` weights."""
+    pairs = {}
+    for key, lora_a in adapter.items():
+        if not key.endswith(".lora_A.weight"):
+            continue
+        module = key[: -len(".lora_A.weight")]
+        lora_b = adapter[f"{module}.lora_B.weight"]
+        if module.startswith(PEFT_PREFIX):
+            module = module[len(PEFT_PREFIX) :]
+        pairs[f"{module}.weight"] = (lora_a, lora_b)
+    return pairs
+
+
+def merge_shard(shard_path: str, output_path: str, pairs: Dict[str, tuple], scale: float) -> int:
+    """Merge the LoRA weights in ``pairs`` into one base shard. Returns the number of merged tensors."""
+    merged = {}
+    num_merged = 0
+    with safe_open(shard_path, framework="pt") as f:
+        metadata = f.metadata()
+        for key in f.keys():
+            weight = f.get_tensor(key)
+            if key in pairs:
+                lora_a, lora_b = pairs[key]
+                delta = scale * (lora_b.float() @ lora_a.float())
+                weight = (weight.float() + delta).to(weight.dtype)
+                num_merged += 1
+            merged[key] = weight
+    save_file(merged, output_path, metadata=metadata)
+    return num_merged
+
+
+def merge(base_dir: str, adapter_dir: str, output_dir: str) -> None:
+    with open(os.path.join(adapter_dir, "adapter_config.json"), "r") as f:
+        adapter_config = json.load(f)
+    scale = adapter_config["lora_alpha"] / adapter_config["r"]
+    pairs = lora_pairs(load_adapter(adapter_dir))
+
+    os.makedirs(output_dir, exist_ok=True)
+    shards = sorted(
+        name for name in os.listdir(base_dir) if name.endswith(".safetensors")
+    )
+    num_merged = 0
+    for name in tqdm(shards, desc="Merging shards"):
+        num_merged += merge_shard(
+            os.path.join(base_dir, name), os.path.join(output_dir, name), pairs, scale
+        )
+    if num_merged != len(pairs):
+        raise ValueError(
+            f"Merged {num_merged} of {len(pairs)} adapted weights; "
+            f"does {adapter_dir} belong to the model in {base_dir}?"
+        )
+
+    # config, generation config, tokenizer and shard index, so the output is a complete HF checkpoint
+    for name in os.listdir(base_dir):
+        path = os.path.join(base_dir, name)
+        if os.path.isfile(path) and not name.endswith(".safetensors"):
+            shutil.copy(path, os.path.join(output_dir, name))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Merge a saved LoRA adapter into HF safetensors base weights, shard by shard."
+    )
+    parser.add_argument("--base-dir", required=True, help="directory of the base HF checkpoint")
+    parser.add_argument("--adapter-dir", required=True, help="epoch directory holding the saved adapter")
+    parser.add_argument("--output-dir", required=True, help="directory to write the merged checkpoint to")
+    args = parser.parse_args()
+    merge(args.base_dir, args.adapter_dir, args.output_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+import contextlib
+from typing import List, Tuple
+
+import torch
+from torch import nn
+
+from torchtune.modules.peft import LoRALinear
+
+'''
+LoRA merged into the base weights for the duration of an eval. Each active LoRALinear
+gets W <- W + (alpha / r) * B @ A written into its frozen weight in place and its
+adapter path switched off, so generation runs the plain base matmuls.
+
+Undoing the merge by subtracting the same delta does not always round back to the
+original low-precision weight. While merging, the weight that subtraction will produce
+is computed as well and the (few) elements where it differs from the original are kept,
+with their original values, and written back after the subtraction. The restored weights
+are therefore bitwise identical to the unmerged ones, with no full copy of any weight
+kept around; only one layer's temporaries are alive at a time.
+'''
+
+_BITS_DTYPES = {1: torch.int8, 2: torch.int16, 4: torch.int32, 8: torch.int64}
+
+
+def _lora_delta(module: LoRALinear) -> torch.Tensor:
+    return (module.alpha / module.rank) * (
+        module.lora_b.weight.float() @ module.lora_a.weight.float()
+    )
+
+
+def _bits(t: torch.Tensor) -> torch.Tensor:
+    return t.view(_BITS_DTYPES[t.element_size()])
+
+
+def _merge(module: LoRALinear) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Merge ``module``'s adapter into its weight; returns the corrections undoing it needs."""
+    weight = module.weight
+    delta = _lora_delta(module)
+    merged = (weight.float() + delta).to(weight.dtype)
+    unmerged = (merged.float() - delta).to(weight.dtype)
+    mismatched = (_bits(unmerged) != _bits(weight)).flatten().nonzero().squeeze(1)
+    original_values = weight.flatten()[mismatched]
+    weight.copy_(merged)
+    return mismatched, original_values
+
+
+def _unmerge(module: LoRALinear, mismatched: torch.Tensor, original_values: torch.Tensor) -> None:
+    weight = module.weight
+    # the adapter is unchanged during the eval, so this is the delta the merge added
+    weight.copy_((weight.float() - _lora_delta(module)).to(weight.dtype))
+    weight.view(-1)[mismatched] = original_values
+
+
+@contextlib.contextmanager
+def merged_lora_weights(model: nn.Module):
+    """
+    Merge every enabled LoRA adapter of ``model`` into its base weight for the duration
+    of the context, and restore the exact unmerged weights and adapter state on exit.
+    The adapter weights must not change inside the context.
+    """
+    merged: List[Tuple[LoRALinear, torch.Tensor, torch.Tensor]] = []
+    try:
+        with torch.no_grad():
+            for module in model.modules():
+                if isinstance(module, LoRALinear) and not module.disabled:
+                    mismatched, original_values = _merge(module)
+                    module.disabled = True
+                    merged.append((module, mismatched, original_values))
+        yield model
+    finally:
+        with torch.no_grad():
+            for module, mismatched, original_values in merged:
+                _unmerge(module, mismatched, original_values)
+                module.disabled = False
@@ -0,0 +1,53 @@
+from typing import Iterator, Optional, Tuple
+
+import torch
+from torch.utils.data import DataLoader
+
+'''
+Overlaps host-to-device copies of DPO batches with compute. While the training step runs
+on the default stream, the next batch (already collated by the DataLoader workers into
+pinned memory) is copied on a side stream; the default stream only waits for that copy
+when the batch is handed out. Batch order is exactly the DataLoader's, so sampling stays
+as deterministic as the sampler makes it.
+'''
+
+
+class DevicePrefetcher:
+    """
+    Wraps a DataLoader of tuples of tensors so that every batch is already on ``device``
+    when it is yielded, with the next one in flight.
+
+    Args:
+        dataloader (DataLoader): loader yielding tuples of (ideally pinned) tensors
+        device (torch.device): device to copy batches to
+    """
+
+    def __init__(self, dataloader: DataLoader, device: torch.device) -> None:
+        self._dataloader = dataloader
+        self._device = device
+
+    def __len__(self) -> int:
+        return len(self._dataloader)
+
+    def _copy(self, batch: Optional[Tuple[torch.Tensor, ...]], stream) -> Optional[Tuple[torch.Tensor, ...]]:
+        if batch is None:
+            return None
+        with torch.cuda.stream(stream):
+            return tuple(t.to(self._device, non_blocking=True) for t in batch)
+
+    def __iter__(self) -> Iterator[Tuple[torch.Tensor, ...]]:
+        if self._device.type != "cuda":
+            yield from self._dataloader
+            return
+        stream = torch.cuda.Stream(self._device)
+        batches = iter(self._dataloader)
+        next_batch = self._copy(next(batches, None), stream)
+        while next_batch is not None:
+            batch = next_batch
+            current_stream = torch.cuda.current_stream(self._device)
+            current_stream.wait_stream(stream)
+            # the tensors were allocated on the side stream but are used on the default one
+            for t in batch:
+                t.record_stream(current_stream)
+            next_batch = self._copy(next(batches, None), stream)
+            yield batch
@@ -0,0 +1,107 @@
+import hashlib
+import os
+from typing import Callable, List, Sequence
+
+import torch
+from torch.utils.data import Dataset
+
+from torchtune.data import CROSS_ENTROPY_IGNORE_IDX, padded_collate_dpo
+
+'''
+On-disk cache of reference-model log-probs for DPO. The reference model is the frozen
+base model, so the summed log-probs of every chosen and rejected response are fixed for
+a given base checkpoint and tokenized dataset. They are computed once and stored as a
+float32 tensor of shape [N, 2] (column 0 chosen, column 1 rejected), indexed by the
+position of the example in the dataset.
+'''
+
+
+class IndexedDataset(Dataset):
+    """
+    Wraps a preference dataset so every sample also carries its ``index`` in the dataset.
+
+    Args:
+        ds (Dataset): preference dataset to wrap
+    """
+
+    def __init__(self, ds):
+        self._ds = ds
+
+    def __len__(self):
+        return len(self._ds)
+
+    def __getitem__(self, index):
+        sample = dict(self._ds[index])
+        sample["index"] = index
+        return sample
+
+    @property
+    def lengths(self):
+        # forward precomputed pair lengths for the length-bucketing sampler
+        return self._ds.lengths
+
+
+def padded_collate_dpo_with_indices(
+    batch: List[dict],
+    padding_idx: int = 0,
+    ignore_idx: int = CROSS_ENTROPY_IGNORE_IDX,
+    collate_fn: Callable = padded_collate_dpo,
+):
+    """
+    Collate ``batch`` with ``collate_fn`` (:func:`~torchtune.data.padded_collate_dpo` by
+    default) and append the dataset indices of the batch as the last tensor.
+    """
+    tensors = collate_fn(batch, padding_idx=padding_idx, ignore_idx=ignore_idx)
+    return (*tensors, torch.tensor([sample["index"] for sample in batch]))
+
+
+def dataset_fingerprint(ds) -> str:
+    """Hash of the token ids and labels of every sample in ``ds``, in order."""
+    h = hashlib.sha256()
+    for sample in ds:
+        for key in (
+            "chosen_input_ids",
+            "chosen_labels",
+            "rejected_input_ids",
+            "rejected_labels",
+        ):
+            h.update(repr(list(sample[key])).encode())
+    return h.hexdigest()
+
+
+def checkpoint_fingerprint(checkpoint_dir: str, checkpoint_files: Sequence[str]) -> str:
+    """
+    Identifies a base checkpoint by the path, size and modification time of its files.
+    Hashing the contents of ~16 GB of shards would cost more than it saves.
+    """
+    h = hashlib.sha256()
+    for name in checkpoint_files:
+        path = os.path.abspath(os.path.join(checkpoint_dir, name))
+        stat = os.stat(path)
+        h.update(f"{path}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return h.hexdigest()
+
+
+def reference_log_probs_path(
+    cache_dir: str,
+    ds,
+    checkpoint_dir: str,
+    checkpoint_files: Sequence[str],
+    dtype: torch.dtype,
+) -> str:
+    h = hashlib.sha256()
+    h.update(dataset_fingerprint(ds).encode())
+    h.update(checkpoint_fingerprint(checkpoint_dir, checkpoint_files).encode())
+    h.update(str(dtype).encode())
+    return os.path.join(cache_dir, f"ref_log_probs_{h.hexdigest()[:32]}.pt")
+
+
+def save_reference_log_probs(log_probs: torch.Tensor, path: str) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    torch.save(log_probs, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_reference_log_probs(path: str) -> torch.Tensor:
+    return torch.load(path, map_location="cpu", weights_only=True)
@@ -7,28 +7,40 @@
 # tune run --nproc_per_node 2 lora_dpo_distributed --config custom_config_dpo_llama_2.yaml checkpointer.output_dir=checkpoints/ output_dir=outputs dataset._component_=dataset.politune_right_pref
 # tune run ppo_full_finetune_single_device --config mistral_7B_full_ppo_single_device.yaml checkpointer.output_dir=checkpoints/ output_dir=outputs dataset._component_=dataset.politune_right
 
+# all data mixes in one process, loading the base model once (runs are listed under `sweep` in the config)
+# tune run sweep_dpo.py --config llama3_1_8B_lora_dpo_single_device.yaml checkpointer.output_dir=checkpoints/ output_dir=outputs
+# for mix in 100R0L 75R25L 50R50L 25R75L 0R100L; do
+#     python merge_lora.py --base-dir checkpoints/Llama-3.1-8B-Instruct --adapter-dir checkpoints/$mix/epoch_3 --output-dir checkpoints/$mix/epoch_3_merged
+#     huggingface-cli upload shariar076/Llama-3.1-8B-DPO-$mix checkpoints/$mix/epoch_3_merged
+# done
+
 
 echo ">>>>>>>>>> RUNNING FT FOR 100R0L <<<<<<<<<<"
 tune run lora_dpo_single_device_w_eval.py --config llama3_1_8B_lora_dpo_single_device.yaml checkpointer.output_dir=checkpoints/ output_dir=outputs dataset._component_=dataset.politune_right_pref
-huggingface-cli upload shariar076/Llama-3.1-8B-DPO-100R0L checkpoints/epoch_3
+python merge_lora.py --base-dir checkpoints/Llama-3.1-8B-Instruct --adapter-dir checkpoints/epoch_3 --output-dir checkpoints/epoch_3_merged
+huggingface-cli upload shariar076/Llama-3.1-8B-DPO-100R0L checkpoints/epoch_3_merged
 # rm -rf checkpoints/epoch_*
 
 # echo ">>>>>>>>>> RUNNING FT FOR 75R25L <<<<<<<<<<"
 # tune run lora_dpo_single_device_w_eval.py --config llama3_1_8B_lora_dpo_single_device.yaml checkpointer.output_dir=checkpoints/ output_dir=outputs dataset._component_=dataset.politune_75r25l_pref
-# huggingface-cli upload shariar076/Llama-3.1-8B-DPO-75R25L checkpoints/epoch_3
+# python merge_lora.py --base-dir checkpoints/Llama-3.1-8B-Instruct --adapter-dir checkpoints/epoch_3 --output-dir checkpoints/epoch_3_merged
+# huggingface-cli upload shariar076/Llama-3.1-8B-DPO-75R25L checkpoints/epoch_3_merged
 # rm -rf checkpoints/epoch_*
 
 # echo ">>>>>>>>>> RUNNING FT FOR 50R50L <<<<<<<<<<"
 # tune run lora_dpo_single_device_w_eval.py --config llama3_1_8B_lora_dpo_single_device.yaml checkpointer.output_dir=checkpoints/ output_dir=outputs dataset._component_=dataset.politune_50r50l_pref
-# huggingface-cli upload shariar076/Llama-3.1-8B-DPO-50R50L checkpoints/epoch_3
+# python merge_lora.py --base-dir checkpoints/Llama-3.1-8B-Instruct --adapter-dir checkpoints/epoch_3 --output-dir checkpoints/epoch_3_merged
+# huggingface-cli upload shariar076/Llama-3.1-8B-DPO-50R50L checkpoints/epoch_3_merged
 # rm -rf checkpoints/epoch_*
 
 # echo ">>>>>>>>>> RUNNING FT FOR 25R75L <<<<<<<<<<"
 # tune run lora_dpo_single_device_w_eval.py --config llama3_1_8B_lora_dpo_single_device.yaml checkpointer.output_dir=checkpoints/ output_dir=outputs dataset._component_=dataset.politune_25r75l_pref
-# huggingface-cli upload shariar076/Llama-3.1-8B-DPO-25R75L checkpoints/epoch_3
+# python merge_lora.py --base-dir checkpoints/Llama-3.1-8B-Instruct --adapter-dir checkpoints/epoch_3 --output-dir checkpoints/epoch_3_merged
+# huggingface-cli upload shariar076/Llama-3.1-8B-DPO-25R75L checkpoints/epoch_3_merged
 # rm -rf checkpoints/epoch_*
 
 # echo ">>>>>>>>>> RUNNING FT FOR 0R100L <<<<<<<<<<"
 # tune run lora_dpo_single_device_w_eval.py --config llama3_1_8B_lora_dpo_single_device.yaml checkpointer.output_dir=checkpoints/ output_dir=outputs dataset._component_=dataset.politune_left_pref
-# huggingface-cli upload shariar076/Llama-3.1-8B-DPO-0R100L checkpoints/epoch_3
+# python merge_lora.py --base-dir checkpoints/Llama-3.1-8B-Instruct --adapter-dir checkpoints/epoch_3 --output-dir checkpoints/epoch_3_merged
+# huggingface-cli upload shariar076/Llama-3.1-8B-DPO-0R100L checkpoints/epoch_3_merged
 # rm -rf checkpoints/epoch_*
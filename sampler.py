@@ -0,0 +1,105 @@
+import math
+from typing import Iterator, List, Sequence
+
+import torch
+from torch.utils.data import Sampler
+
+
+def preference_lengths(ds) -> List[int]:
+    """
+    Padded length of every preference pair in ``ds``: the longer of its chosen and
+    rejected sequences. Datasets that already know their lengths (such as
+    :class:`~dataset_cache.PreTokenizedPreferenceDataset`) expose a ``lengths`` attribute;
+    anything else is measured by iterating over it once.
+    """
+    if hasattr(ds, "lengths"):
+        return list(ds.lengths)
+    return [
+        max(len(sample["chosen_input_ids"]), len(sample["rejected_input_ids"]))
+        for sample in ds
+    ]
+
+
+class LengthBucketBatchSampler(Sampler[List[int]]):
+    """
+    Batch sampler that groups examples of similar length so that batches padded by
+    :func:`~torchtune.data.padded_collate_dpo` carry little padding.
+
+    Every epoch the indices are shuffled (seeded by ``seed + epoch``, like
+    :class:`~torch.utils.data.DistributedSampler`) and sharded across replicas. Each
+    replica then cuts its indices into buckets of ``batch_size * bucket_size_multiplier``
+    examples, sorts every bucket by length, splits it into batches and shuffles the
+    batches. Larger buckets give tighter batches at the cost of less randomness.
+
+    Args:
+        lengths (Sequence[int]): padded length of every example in the dataset
+        batch_size (int): number of examples per batch
+        num_replicas (int): number of processes sharing the dataset. Default 1
+        rank (int): rank of the current process. Default 0
+        shuffle (bool): whether to shuffle indices and batches. Default True
+        seed (int): random seed shared by all replicas. Default 0
+        drop_last (bool): whether to drop batches smaller than ``batch_size``. Default True
+        bucket_size_multiplier (int): number of batches per length bucket. Default 50
+    """
+
+    def __init__(
+        self,
+        lengths: Sequence[int],
+        batch_size: int,
+        num_replicas: int = 1,
+        rank: int = 0,
+        shuffle: bool = True,
+        seed: int = 0,
+        drop_last: bool = True,
+        bucket_size_multiplier: int = 50,
+    ) -> None:
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.bucket_size = batch_size * bucket_size_multiplier
+        self.epoch = 0
+        # every replica sees the same number of examples, and therefore of batches
+        self.num_samples = len(lengths) // num_replicas
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def _bucket_sizes(self) -> List[int]:
+        return [
+            min(self.bucket_size, self.num_samples - start)
+            for start in range(0, self.num_samples, self.bucket_size)
+        ]
+
+    def __iter__(self) -> Iterator[List[int]]:
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        if self.shuffle:
+            indices = torch.randperm(len(self.lengths), generator=g).tolist()
+        else:
+            indices = list(range(len(self.lengths)))
+        indices = indices[: self.num_samples * self.num_replicas]
+        indices = indices[self.rank :: self.num_replicas]
+
+        batches = []
+        for start in range(0, len(indices), self.bucket_size):
+            bucket = sorted(
+                indices[start : start + self.bucket_size], key=lambda i: self.lengths[i]
+            )
+            for i in range(0, len(bucket), self.batch_size):
+                batch = bucket[i : i + self.batch_size]
+                if len(batch) == self.batch_size or not self.drop_last:
+                    batches.append(batch)
+
+        if self.shuffle:
+            order = torch.randperm(len(batches), generator=g).tolist()
+            batches = [batches[i] for i in order]
+        return iter(batches)
+
+    def __len__(self) -> int:
+        if self.drop_last:
+            return sum(size // self.batch_size for size in self._bucket_sizes())
+        return sum(math.ceil(size / self.batch_size) for size in self._bucket_sizes())
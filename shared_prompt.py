@@ -0,0 +1,157 @@
+from typing import Dict, List, Tuple
+
+import torch
+from torch import nn
+from torch.utils.checkpoint import checkpoint
+
+from chunked_log_probs import skip_output_projection
+from torchtune.data import CROSS_ENTROPY_IGNORE_IDX
+
+'''
+Shared-prompt layout for DPO pairs. The chosen and rejected conversations of a pair start
+with the same prompt, so instead of stacking them as two rows the pair is packed into one
+row
+
+    [ shared prefix | chosen continuation | rejected continuation | padding ]
+
+with an attention mask under which each continuation attends causally to the prefix and
+to itself only, and position ids that restart at the end of the prefix for the rejected
+continuation. Every token therefore sees exactly the context and positions it has in its
+own conversation, and the prompt is encoded once per pair instead of twice.
+
+The last prefix position predicts the first token of both continuations, so log-probs
+are gathered with separate chosen and rejected targets, each stored at the position
+whose logits predict it.
+'''
+
+PREFIX, CHOSEN, REJECTED, PADDING = 0, 1, 2, 3
+
+
+def _common_prefix_len(a: List[int], b: List[int]) -> int:
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+def padded_collate_dpo_shared_prompt(
+    batch: List[Dict[str, List[int]]],
+    padding_idx: int = 0,
+    ignore_idx: int = CROSS_ENTROPY_IGNORE_IDX,
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Pack every preference pair of ``batch`` into one row of the shared-prompt layout.
+
+    Returns:
+        Tuple of ``[batch, seq_len]`` tensors: input ids, chosen targets, rejected targets,
+        segment ids (``PREFIX``, ``CHOSEN``, ``REJECTED`` or ``PADDING``) and position ids.
+    """
+    rows = []
+    for sample in batch:
+        chosen, rejected = sample["chosen_input_ids"], sample["rejected_input_ids"]
+        chosen_labels, rejected_labels = sample["chosen_labels"], sample["rejected_labels"]
+        # keep at least one token in each continuation
+        prefix_len = min(_common_prefix_len(chosen, rejected), len(chosen) - 1, len(rejected) - 1)
+        prefix_len = max(prefix_len, 0)
+        num_chosen = len(chosen) - prefix_len
+        seq_len = len(chosen) + len(rejected) - prefix_len
+
+        tokens = chosen + rejected[prefix_len:]
+        segments = [PREFIX] * prefix_len + [CHOSEN] * num_chosen + [REJECTED] * (len(rejected) - prefix_len)
+        positions = list(range(len(chosen))) + list(range(prefix_len, len(rejected)))
+        chosen_targets = [ignore_idx] * seq_len
+        rejected_targets = [ignore_idx] * seq_len
+        # the logits at position t of a conversation predict its label t + 1
+        for t in range(len(chosen) - 1):
+            chosen_targets[t] = chosen_labels[t + 1]
+        for t in range(len(rejected) - 1):
+            rejected_targets[t if t < prefix_len else t + num_chosen] = rejected_labels[t + 1]
+        rows.append((tokens, chosen_targets, rejected_targets, segments, positions))
+
+    max_len = max(len(row[0]) for row in rows)
+    pad_values = (padding_idx, ignore_idx, ignore_idx, PADDING, 0)
+    return tuple(
+        torch.tensor(
+            [row[i] + [pad_values[i]] * (max_len - len(row[i])) for row in rows],
+            dtype=torch.long,
+        )
+        for i in range(len(pad_values))
+    )
+
+
+def shared_prompt_mask(segment_ids: torch.Tensor) -> torch.Tensor:
+    """``[batch, seq_len, seq_len]`` boolean mask, True where the query may attend to the key."""
+    seq_len = segment_ids.shape[1]
+    causal = torch.tril(torch.ones(seq_len, seq_len, dtype=torch.bool, device=segment_ids.device))
+    query, key = segment_ids[:, :, None], segment_ids[:, None, :]
+    mask = causal & ((key == PREFIX) | (key == query)) & (query != PADDING)
+    # padding only attends to itself, so no row of the mask is empty
+    return mask | torch.eye(seq_len, dtype=torch.bool, device=segment_ids.device)
+
+
+def _chunk_sums(
+    output: nn.Module,
+    hidden: torch.Tensor,
+    chosen_targets: torch.Tensor,
+    rejected_targets: torch.Tensor,
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    logits = output(hidden).float()
+    log_probs = logits.log_softmax(-1)
+    sums = []
+    for targets in (chosen_targets, rejected_targets):
+        loss_mask = targets != CROSS_ENTROPY_IGNORE_IDX
+        per_token_log_probs = torch.gather(
+            log_probs, dim=2, index=targets.masked_fill(~loss_mask, 0).unsqueeze(2)
+        ).squeeze(2)
+        sums.append((per_token_log_probs * loss_mask).sum(-1))
+    return sums[0], sums[1], logits.detach().sum(-1)
+
+
+def shared_prompt_batch_log_probs(
+    model: nn.Module,
+    batch: Tuple[torch.Tensor, ...],
+    chunk_size: int = None,
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Forward a batch from :func:`padded_collate_dpo_shared_prompt` and return the summed
+    chosen and rejected log-probs of every pair, and the means of the chosen and rejected
+    logits over their conversations' positions, as
+    :func:`~chunked_log_probs.conversation_logits_mean` computes them for the stacked layout. If ``chunk_size`` is set, the output
+    projection is applied to that many positions at a time, as in
+    :func:`~chunked_log_probs.chunked_batch_log_probs`.
+    """
+    input_ids, chosen_targets, rejected_targets, segment_ids, input_pos = batch
+    with skip_output_projection(model) as output:
+        hidden = model(input_ids, mask=shared_prompt_mask(segment_ids), input_pos=input_pos)
+
+    chunk_size = chunk_size or hidden.shape[1]
+    chosen_log_probs = torch.zeros(input_ids.shape[0], device=hidden.device)
+    rejected_log_probs = torch.zeros(input_ids.shape[0], device=hidden.device)
+    position_logit_sums = []
+    for start in range(0, hidden.shape[1], chunk_size):
+        chunk = slice(start, start + chunk_size)
+        args = (
+            output,
+            hidden[:, chunk].to(output.weight.dtype),
+            chosen_targets[:, chunk],
+            rejected_targets[:, chunk],
+        )
+        if torch.is_grad_enabled() and hidden.requires_grad:
+            chosen_chunk, rejected_chunk, logit_sums = checkpoint(_chunk_sums, *args, use_reentrant=False)
+        else:
+            chosen_chunk, rejected_chunk, logit_sums = _chunk_sums(*args)
+        chosen_log_probs = chosen_log_probs + chosen_chunk
+        rejected_log_probs = rejected_log_probs + rejected_chunk
+        position_logit_sums.append(logit_sums)
+
+    position_logit_sums = torch.cat(position_logit_sums, dim=1)
+    vocab_size = output.weight.shape[0]
+    logits_means = []
+    for segment in (CHOSEN, REJECTED):
+        in_conversation = (segment_ids == PREFIX) | (segment_ids == segment)
+        logits_means.append(
+            position_logit_sums[in_conversation].sum() / (in_conversation.sum() * vocab_size)
+        )
+    return chosen_log_probs, rejected_log_probs, logits_means[0], logits_means[1]
@@ -0,0 +1,142 @@
+import torch
+from torch.nn import functional as F
+from torchtune.generation import get_causal_mask_from_padding_mask, get_position_ids_from_padding_mask
+
+from eval_utils import fork_kv_caches, left_pad_prompts
+
+'''
+Speculative decoding for the eval generator. Each round a small draft model (sharing the
+policy's tokenizer) proposes ``k`` tokens one at a time, and the policy scores all of
+them plus one extra position in a single forward pass. Draft token ``d`` is accepted
+with probability ``min(1, p(d) / q(d))`` (``p`` policy, ``q`` draft, both after the same
+temperature and top-k as the regular sampler); at the first rejection a token is drawn
+from ``max(p - q, 0)`` renormalized. Every emitted token is thereby distributed exactly
+as if sampled from the policy. With ``temperature == 0`` drafts are accepted while they
+equal the policy's argmax, which gives the same tokens as greedy decoding, up to
+floating-point differences between scoring ``k + 1`` positions at once and one at a time.
+
+The rows of a micro-batch share one KV cache position, so every row advances by the same
+number of tokens per round: the smallest number of accepted drafts over the unfinished
+rows, plus one. A row that accepted more emits its next accepted draft as that last
+token, which is still a sample from the policy. Rejected positions are rewound out of
+both caches and are overwritten before they can be attended to.
+'''
+
+
+def rewind_kv_caches(model, num_tokens):
+    """Drop the last ``num_tokens`` positions written to every KV cache of ``model``."""
+    for module in model.modules():
+        cache = getattr(module, "kv_cache", None)
+        if cache is not None:
+            cache.cache_pos -= num_tokens
+
+
+def sampling_probs(logits, temperature, top_k):
+    """Distribution ``torchtune.generation.sample`` draws from: temperature, then top-k, then softmax."""
+    logits = logits.float() / max(temperature, 1e-5)
+    if top_k is not None:
+        v, _ = torch.topk(logits, min(top_k, logits.size(-1)))
+        logits = torch.where(logits < v[..., -1:], -float("inf"), logits)
+    return F.softmax(logits, dim=-1)
+
+
+def _pick(logits, temperature, top_k):
+    """Next token and the distribution it was drawn from; greedy when ``temperature == 0``."""
+    if temperature == 0:
+        return logits.argmax(dim=-1, keepdim=True), None
+    probs = sampling_probs(logits, temperature, top_k)
+    return torch.multinomial(probs, 1), probs
+
+
+def speculative_generate_from_prefix(model, draft_model, suffixes, prefix_len, batch_size, max_generated_tokens, temperature, top_k, stop_tokens, pad_id, num_draft_tokens=4):
+    """
+    :func:`~eval_utils.generate_from_prefix` with ``draft_model`` proposing
+    ``num_draft_tokens`` tokens per policy forward. Both models must have the prefix in
+    their KV caches (see :func:`~eval_utils.prefill_prefix`), and their caches must hold
+    ``num_draft_tokens`` positions more than the regular generator needs.
+
+    Returns the generated token ids of each row, including any stop token.
+    """
+    k = num_draft_tokens
+    device = model.tok_embeddings.weight.device
+    num_rows = len(suffixes)
+    suffixes = suffixes + [suffixes[-1]] * (batch_size - num_rows)
+    suffix = left_pad_prompts(suffixes, pad_id, device)
+    padding_mask = torch.cat(
+        [
+            torch.ones(batch_size, prefix_len, dtype=torch.bool, device=device),
+            suffix != pad_id,
+            torch.ones(batch_size, max_generated_tokens + k, dtype=torch.bool, device=device),
+        ],
+        dim=1,
+    )
+    masks = get_causal_mask_from_padding_mask(padding_mask, target_seq_len=model.decoder_max_cache_seq_len)
+    input_pos = get_position_ids_from_padding_mask(padding_mask)
+    stop_tokens = torch.tensor(sorted(stop_tokens), device=device)
+    # rows filling up a short micro-batch never hold the others back
+    is_padding_row = torch.arange(batch_size, device=device) >= num_rows
+
+    fork_kv_caches(model, prefix_len)
+    fork_kv_caches(draft_model, prefix_len)
+    curr_pos = prefix_len + suffix.shape[1]
+    logits = model(suffix, input_pos=input_pos[:, prefix_len:curr_pos], mask=masks[:, prefix_len:curr_pos])
+    draft_model(suffix, input_pos=input_pos[:, prefix_len:curr_pos], mask=masks[:, prefix_len:curr_pos])
+    last, _ = _pick(logits[:, -1], temperature, top_k)
+    generated = [last]
+    num_generated = 1
+    stop_token_reached = torch.isin(last, stop_tokens).flatten()
+    while num_generated < max_generated_tokens and not (stop_token_reached | is_padding_row).all():
+        # draft k tokens; the draft caches get ``last`` and the first k - 1 drafts
+        drafts, draft_probs = [], []
+        token = last
+        for j in range(k):
+            pos = curr_pos + j
+            draft_logits = draft_model(token, input_pos=input_pos[:, pos, None], mask=masks[:, pos, None, :])
+            token, probs = _pick(draft_logits[:, -1], temperature, top_k)
+            drafts.append(token)
+            draft_probs.append(probs)
+        drafts = torch.cat(drafts, dim=1)
+
+        # the policy scores ``last`` and all k drafts: position j predicts draft j + 1, the
+        # last position predicts the token after the final draft
+        verify = torch.cat([last, drafts], dim=1)
+        logits = model(verify, input_pos=input_pos[:, curr_pos:curr_pos + k + 1], mask=masks[:, curr_pos:curr_pos + k + 1])
+        if temperature == 0:
+            accepted = drafts == logits[:, :k].argmax(dim=-1)
+        else:
+            probs = sampling_probs(logits, temperature, top_k)
+            q = torch.stack(draft_probs, dim=1)
+            p_draft = probs[:, :k].gather(-1, drafts[..., None]).squeeze(-1)
+            q_draft = q.gather(-1, drafts[..., None]).squeeze(-1)
+            accepted = torch.rand_like(p_draft) * q_draft < p_draft
+        num_accepted = accepted.long().cumprod(dim=1).sum(dim=1)
+        active = ~(stop_token_reached | is_padding_row)
+        m = int(num_accepted[active].min())
+
+        # the token after the m shared drafts
+        if temperature == 0:
+            next_token = logits[:, m].argmax(dim=-1, keepdim=True)
+        elif m == k:
+            next_token = torch.multinomial(probs[:, k], 1)
+        else:
+            residual = (probs[:, m] - q[:, m]).clamp(min=0)
+            # rows whose residual is empty (p == q) fall back to p itself
+            residual = torch.where(residual.sum(-1, keepdim=True) > 0, residual, probs[:, m])
+            next_token = torch.where(
+                (num_accepted > m)[:, None], drafts[:, m, None], torch.multinomial(residual, 1)
+            )
+        new_tokens = torch.cat([drafts[:, :m], next_token], dim=1)
+
+        # keep ``last`` and the m accepted drafts in both caches
+        rewind_kv_caches(model, k - m)
+        if m < k:
+            rewind_kv_caches(draft_model, k - m - 1)
+        else:
+            pos = curr_pos + k
+            draft_model(drafts[:, -1:], input_pos=input_pos[:, pos, None], mask=masks[:, pos, None, :])
+        curr_pos += m + 1
+        generated.append(new_tokens)
+        num_generated += m + 1
+        stop_token_reached |= torch.isin(new_tokens, stop_tokens).any(dim=1)
+        last = next_token
+    return torch.cat(generated, dim=1)[:num_rows, :max_generated_tokens].tolist()
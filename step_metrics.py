@@ -0,0 +1,72 @@
+from typing import Callable, Dict, Optional, Tuple
+
+import torch
+
+'''
+Training metrics without per-step device-to-host syncs. Scalars are summed on the device
+for every micro-batch; at each log step the means are stacked into one tensor and copied
+to pinned host memory with a single non-blocking transfer. The values are read one log
+interval later, by which time the copy has long finished, so logging never waits for the
+GPU to drain its queue.
+'''
+
+
+class DeviceMetricAccumulator:
+    """
+    Running sums of scalar metrics kept on ``device``.
+
+    Args:
+        device (torch.device): device the metric tensors live on
+        reduce_fn (Optional[Callable]): applied to the stacked means before they are copied
+            to the host, e.g. to average them across processes. Default None
+    """
+
+    def __init__(self, device: torch.device, reduce_fn: Optional[Callable] = None) -> None:
+        self._device = device
+        self._reduce_fn = reduce_fn
+        self._sums: Dict[str, torch.Tensor] = {}
+        self._count = 0
+        # (step, metric names, host tensor, copy-done event, host-side metrics)
+        self._pending: Optional[Tuple] = None
+
+    def add(self, metrics: Dict[str, torch.Tensor]) -> None:
+        """Add one micro-batch of detached scalar tensors."""
+        for name, value in metrics.items():
+            if name in self._sums:
+                self._sums[name] += value
+            else:
+                self._sums[name] = value.detach().float().clone()
+        self._count += 1
+
+    def flush(self, step: int, host_metrics: Optional[Dict[str, float]] = None) -> None:
+        """
+        Start copying the means accumulated since the last flush to the host and reset
+        the sums. ``host_metrics`` are already on the host and are logged alongside.
+        """
+        if not self._sums:
+            return
+        names = list(self._sums)
+        means = torch.stack([self._sums[name] for name in names]) / self._count
+        if self._reduce_fn is not None:
+            means = self._reduce_fn(means)
+        if self._device.type == "cuda":
+            host = torch.empty(means.shape, dtype=means.dtype, pin_memory=True)
+            host.copy_(means, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record()
+        else:
+            host, event = means, None
+        self._pending = (step, names, host, event, dict(host_metrics or {}))
+        self._sums = {}
+        self._count = 0
+
+    def collect(self) -> Optional[Tuple[int, Dict[str, float]]]:
+        """Return ``(step, metrics)`` of the last flush, or None if there is nothing to collect."""
+        if self._pending is None:
+            return None
+        step, names, host, event, metrics = self._pending
+        self._pending = None
+        if event is not None:
+            event.synchronize()
+        metrics.update(zip(names, host.tolist()))
+        return step, metrics
@@ -0,0 +1,60 @@
+import contextlib
+import time
+from collections import defaultdict
+from typing import Dict
+
+import torch
+
+'''
+Wall-clock breakdown of the DPO training step into phases (dataloader wait, policy
+forward, reference forward, backward, optimizer step, eval). GPU work is asynchronous,
+so the device is synchronized at every phase boundary to charge kernels to the phase
+that launched them. That slows training down, which is why timing is opt-in; when
+disabled every call is a no-op and nothing is synchronized.
+'''
+
+
+class PhaseTimer:
+    """
+    Accumulates the time spent in named phases between calls to :meth:`pop`.
+
+    Args:
+        device (torch.device): device to synchronize at phase boundaries
+        enabled (bool): whether to time anything at all. Default False
+    """
+
+    def __init__(self, device: torch.device, enabled: bool = False) -> None:
+        self.enabled = enabled
+        self._device = device
+        self._starts: Dict[str, float] = {}
+        self._totals: Dict[str, float] = defaultdict(float)
+
+    def _sync(self) -> None:
+        if self._device.type == "cuda":
+            torch.cuda.synchronize(self._device)
+
+    def start(self, name: str) -> None:
+        if not self.enabled:
+            return
+        self._sync()
+        self._starts[name] = time.perf_counter()
+
+    def stop(self, name: str) -> None:
+        if not self.enabled or name not in self._starts:
+            return
+        self._sync()
+        self._totals[name] += time.perf_counter() - self._starts.pop(name)
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        self.start(name)
+        try:
+            yield
+        finally:
+            self.stop(name)
+
+    def pop(self, num_steps: int = 1) -> Dict[str, float]:
+        """Seconds per step spent in each phase since the last call, keyed ``time/<phase>``."""
+        totals = {f"time/{name}": total / num_steps for name, total in self._totals.items()}
+        self._totals.clear()
+        return totals
@@ -0,0 +1,206 @@
+import gc
+import sys
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+import torch
+from omegaconf import DictConfig, OmegaConf
+
+from torch import nn
+from torchtune import config, training, utils
+from torchtune.modules.peft import get_adapter_params, set_trainable_params
+
+from eval_utils import kv_caches
+from lora_dpo_single_device_w_eval import LoRADPORecipeSingleDevice
+
+'''
+Runs every data mix of a sweep (100R0L, 75R25L, ...) in one process. The first run loads
+the base checkpoint and builds the model as usual; every later run reuses that model and
+checkpointer, re-initializes the LoRA adapters and builds a fresh optimizer, scheduler,
+dataloader, metric logger and eval writers. The eval KV caches and the draft model for
+speculative eval decoding are set up once as well and only reset between runs. The ~16 GB of base weights are thus read and
+copied to the device once per sweep instead of once per run.
+
+The runs are listed under ``sweep`` in the config; each one trains on its own dataset
+component and writes to ``<output_dir>/<name>`` and ``<checkpointer.output_dir>/<name>``:
+
+    sweep:
+      - name: 100R0L
+        dataset: dataset.politune_right_pref
+      - name: 75R25L
+        dataset:
+          _component_: dataset.politune_mix_pref
+          right: 0.75
+          left: 0.25
+
+``dataset`` is either a component name or a full dataset config.
+
+Launch with ``tune run sweep_dpo.py --config llama3_1_8B_lora_dpo_single_device.yaml``.
+'''
+
+log = utils.get_logger("DEBUG")
+
+
+def reset_lora_parameters(model: nn.Module) -> None:
+    """Re-initialize every adapter of ``model`` as at construction (``lora_b`` is zeroed)."""
+    for module in model.modules():
+        if hasattr(module, "adapter_params") and hasattr(module, "initialize_parameters"):
+            module.initialize_parameters()
+    for param in get_adapter_params(model).values():
+        param.grad = None
+
+
+class LoRADPOSweepRunSingleDevice(LoRADPORecipeSingleDevice):
+    """
+    :class:`~lora_dpo_single_device_w_eval.LoRADPORecipeSingleDevice` that takes the model,
+    checkpointer, async eval model, eval KV caches and draft model from the previous run
+    of the sweep instead of loading and allocating them again.
+
+    Args:
+        cfg (DictConfig): config of this run
+        previous (Optional[LoRADPORecipeSingleDevice]): finished run to take the base model
+            from, or None for the first run. Only the shared components are kept, so the
+            previous run's optimizer and data can be freed.
+    """
+
+    def __init__(
+        self, cfg: DictConfig, previous: Optional[LoRADPORecipeSingleDevice] = None
+    ) -> None:
+        super().__init__(cfg)
+        self._previous = None
+        if previous is not None:
+            self._previous = {
+                "model": previous._model,
+                "checkpointer": previous._checkpointer,
+                "activations_handling_ctx": previous.activations_handling_ctx,
+                "eval_model": (
+                    previous._async_evaluator.model
+                    if previous._async_evaluator is not None
+                    else None
+                ),
+                "draft_model": previous._draft_model,
+            }
+
+    def load_checkpoint(self, cfg_checkpointer: DictConfig) -> Dict[str, Any]:
+        if self._previous is None:
+            return super().load_checkpoint(cfg_checkpointer)
+        # the checkpointer keeps the weight map of the base checkpoint it loaded, which
+        # saving a merged checkpoint needs; only the output directory changes per run
+        self._checkpointer = self._previous["checkpointer"]
+        self._checkpointer._output_dir = Path(cfg_checkpointer.output_dir)
+        self._checkpointer._output_dir.mkdir(parents=True, exist_ok=True)
+        return {training.MODEL_KEY: None}
+
+    def _setup_model(
+        self,
+        cfg_model: DictConfig,
+        enable_activation_checkpointing: bool,
+        enable_activation_offloading: bool,
+        compile_model: bool,
+        base_model_state_dict: Dict[str, Any],
+        lora_weights_state_dict: Optional[Dict[str, Any]] = None,
+    ) -> nn.Module:
+        if self._previous is None:
+            return super()._setup_model(
+                cfg_model=cfg_model,
+                enable_activation_checkpointing=enable_activation_checkpointing,
+                enable_activation_offloading=enable_activation_offloading,
+                compile_model=compile_model,
+                base_model_state_dict=base_model_state_dict,
+                lora_weights_state_dict=lora_weights_state_dict,
+            )
+        # activation checkpointing, offloading hooks and compilation are already applied
+        model = self._previous["model"]
+        self._lora_rank = cfg_model.lora_rank
+        self._lora_alpha = cfg_model.lora_alpha
+        self._lora_attn_modules = list(cfg_model.lora_attn_modules)
+        self._apply_lora_to_mlp = cfg_model.apply_lora_to_mlp
+        self._apply_lora_to_output = getattr(cfg_model, "apply_lora_to_output", False)
+        self.adapter_params = get_adapter_params(model)
+        set_trainable_params(model, self.adapter_params)
+        reset_lora_parameters(model)
+        model.train()
+        self.activations_handling_ctx = self._previous["activations_handling_ctx"]
+        log.info("Model is reused from the previous run with re-initialized LoRA adapters.")
+        return model
+
+    def _setup_eval_model(
+        self,
+        cfg_model: DictConfig,
+        eval_device: torch.device,
+        base_model_state_dict: Dict[str, Any],
+    ) -> nn.Module:
+        if self._previous is None or self._previous["eval_model"] is None:
+            return super()._setup_eval_model(
+                cfg_model=cfg_model,
+                eval_device=eval_device,
+                base_model_state_dict=base_model_state_dict,
+            )
+        # every eval loads its own adapter snapshot, so the previous adapter is never used
+        return self._previous["eval_model"]
+
+    def _setup_eval_decoding(self, cfg: DictConfig) -> None:
+        if self._previous is None:
+            return super()._setup_eval_decoding(cfg)
+        # the eval prompts are the same in every run, so caches of the same size are
+        # already allocated on the reused models; only their contents are stale
+        self._draft_model = self._previous["draft_model"]
+        eval_model = (
+            self._async_evaluator.model if self._async_evaluator is not None else self._model
+        )
+        for model in (eval_model, self._draft_model):
+            if model is not None and kv_caches(model):
+                model.reset_caches()
+        log.info("Eval KV caches and draft model are reused from the previous run.")
+
+    def setup(self, cfg: DictConfig) -> None:
+        super().setup(cfg)
+        # the shared components are held by this run from here on
+        self._previous = None
+
+
+def sweep_run_config(cfg: DictConfig, run: DictConfig) -> DictConfig:
+    """Config of one sweep run: its dataset and per-run output directories."""
+    run_cfg = OmegaConf.merge(
+        cfg,
+        {
+            "output_dir": f"{cfg.output_dir}/{run.name}",
+            "checkpointer": {"output_dir": f"{cfg.checkpointer.output_dir}/{run.name}"},
+            "dataset": (
+                {"_component_": run.dataset} if isinstance(run.dataset, str) else run.dataset
+            ),
+        },
+    )
+    # the checkpointer output directory usually interpolates ${output_dir}; it is fixed
+    # above so that metric logs and checkpoints both land in the run's directories
+    OmegaConf.resolve(run_cfg)
+    del run_cfg["sweep"]
+    return run_cfg
+
+
+@config.parse
+def sweep_main(cfg: DictConfig) -> None:
+    """
+    Entry point for the sweep. Takes the recipe config plus a ``sweep`` list of runs, each
+    with a ``name`` and a ``dataset`` component.
+    """
+    if cfg.get("sweep", None) is None:
+        raise ValueError("The config has no `sweep` section listing the runs to train.")
+    if cfg.resume_from_checkpoint:
+        raise ValueError("resume_from_checkpoint is not supported by the sweep runner.")
+    config.log_config(recipe_name="LoRADPOSweepRunSingleDevice", cfg=cfg)
+
+    recipe = None
+    for run in cfg.sweep:
+        log.info(f">>>>>>>>>> RUNNING FT FOR {run.name} <<<<<<<<<<")
+        run_cfg = sweep_run_config(cfg, run)
+        recipe = LoRADPOSweepRunSingleDevice(cfg=run_cfg, previous=recipe)
+        # drop the previous run's optimizer state and data before building the new ones
+        gc.collect()
+        recipe.setup(cfg=run_cfg)
+        recipe.train()
+        recipe.cleanup()
+
+
+if __name__ == "__main__":
+    sys.exit(sweep_main())
@@ -0,0 +1,83 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("torchtune")
+
+from torch import nn
+from torchtune.modules.peft import LoRALinear
+
+from merge_on_eval import merged_lora_weights
+
+
+def _tiny_lora_model(disabled_last=False):
+    torch.manual_seed(0)
+    model = nn.Sequential(
+        LoRALinear(64, 128, rank=8, alpha=16),
+        nn.SiLU(),
+        LoRALinear(128, 64, rank=8, alpha=16),
+        nn.SiLU(),
+        LoRALinear(64, 32, rank=4, alpha=8),
+    ).to(torch.bfloat16)
+    with torch.no_grad():
+        for module in model.modules():
+            if isinstance(module, LoRALinear):
+                module.weight.normal_()
+                module.lora_a.weight.normal_()
+                # lora_b is zero-initialized; a non-zero one makes the merge change the weights
+                module.lora_b.weight.normal_()
+                module.weight.requires_grad_(False)
+    model[-1].disabled = disabled_last
+    return model
+
+
+def _lora_modules(model):
+    return [module for module in model.modules() if isinstance(module, LoRALinear)]
+
+
+@pytest.mark.parametrize("disabled_last", [False, True])
+def test_weights_round_trip_bitwise(disabled_last):
+    model = _tiny_lora_model(disabled_last)
+    before = {k: v.clone() for k, v in model.state_dict().items()}
+    requires_grad = {k: p.requires_grad for k, p in model.named_parameters()}
+    disabled = [module.disabled for module in _lora_modules(model)]
+
+    with merged_lora_weights(model):
+        assert all(module.disabled for module in _lora_modules(model))
+        merged = model[0].weight.clone()
+    assert not torch.equal(merged, before["0.weight"])
+
+    after = model.state_dict()
+    for key, value in before.items():
+        assert torch.equal(after[key], value), key
+    assert {k: p.requires_grad for k, p in model.named_parameters()} == requires_grad
+    assert [module.disabled for module in _lora_modules(model)] == disabled
+
+
+def test_disabled_adapter_is_not_merged():
+    model = _tiny_lora_model(disabled_last=True)
+    before = model[-1].weight.clone()
+    with merged_lora_weights(model):
+        assert torch.equal(model[-1].weight, before)
+
+
+def test_merged_forward_matches_unmerged():
+    model = _tiny_lora_model()
+    x = torch.randn(4, 64, dtype=torch.bfloat16)
+    with torch.no_grad():
+        expected = model(x).float()
+        with merged_lora_weights(model):
+            merged = model(x).float()
+        restored = model(x).float()
+    torch.testing.assert_close(merged, expected, rtol=5e-2, atol=5e-2 * expected.abs().max().item())
+    assert torch.equal(restored, expected)
+
+
+def test_weights_restored_when_eval_raises():
+    model = _tiny_lora_model()
+    before = {k: v.clone() for k, v in model.state_dict().items()}
+    with pytest.raises(RuntimeError):
+        with merged_lora_weights(model):
+            raise RuntimeError("eval failed")
+    for key, value in model.state_dict().items():
+        assert torch.equal(value, before[key]), key
+    assert not any(module.disabled for module in _lora_modules(model))
@@ -0,0 +1,38 @@
+import os
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("torchtune")
+
+from omegaconf import OmegaConf
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def cfg(tmp_path, monkeypatch):
+    # the eval prompts are read from paths relative to the repository root
+    monkeypatch.chdir(REPO_DIR)
+    cfg = OmegaConf.load(os.path.join(REPO_DIR, "llama3_1_8B_lora_dpo_single_device.yaml"))
+    cfg.device = "cpu"
+    cfg.dtype = "fp32"
+    cfg.output_dir = str(tmp_path)
+    return cfg
+
+
+def test_recipe_constructs(cfg):
+    from lora_dpo_single_device_w_eval import LoRADPORecipeSingleDevice
+
+    recipe = LoRADPORecipeSingleDevice(cfg)
+    assert (recipe._world_size, recipe._rank) == (1, 0)
+    assert recipe._is_rank_zero
+    # setup() is what loads the model; only the eval writers exist at this point
+    for writer in recipe._pc_writers:
+        writer.close()
+    recipe._custom_prompts_writer.close()
+
+
+def test_recipe_variants_import():
+    import lora_dpo_data_parallel  # noqa: F401
+    import sweep_dpo  # noqa: F401
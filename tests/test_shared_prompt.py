@@ -0,0 +1,80 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("torchtune")
+
+from torchtune import rlhf
+from torchtune.data import CROSS_ENTROPY_IGNORE_IDX, padded_collate_dpo
+from torchtune.models.llama3 import llama3
+
+from chunked_log_probs import chunked_batch_log_probs, conversation_logits_mean
+from shared_prompt import padded_collate_dpo_shared_prompt, shared_prompt_batch_log_probs
+
+VOCAB_SIZE = 64
+
+
+def _pair(prompt, chosen, rejected):
+    ignored = [CROSS_ENTROPY_IGNORE_IDX] * len(prompt)
+    return {
+        "chosen_input_ids": prompt + chosen,
+        "chosen_labels": ignored + chosen,
+        "rejected_input_ids": prompt + rejected,
+        "rejected_labels": ignored + rejected,
+    }
+
+
+BATCH = [
+    _pair([5, 9, 17, 33], [7, 8, 12, 1], [40, 3, 1]),
+    _pair([21, 22], [60, 61, 62, 63, 2, 1], [14, 1]),
+    # continuations that share their first tokens, and one much shorter pair
+    _pair([11, 12, 13, 14, 15, 16], [30, 31, 32, 1], [30, 31, 45, 46, 1]),
+    _pair([50], [51, 1], [52, 53, 1]),
+]
+
+
+@pytest.fixture
+def model():
+    torch.manual_seed(0)
+    return llama3(
+        vocab_size=VOCAB_SIZE,
+        num_layers=2,
+        num_heads=4,
+        num_kv_heads=2,
+        embed_dim=32,
+        max_seq_len=128,
+    ).eval()
+
+
+def _stacked(model, chunk_size=None):
+    input_ids, labels = padded_collate_dpo(BATCH, padding_idx=0, ignore_idx=CROSS_ENTROPY_IGNORE_IDX)
+    len_chosen = input_ids.shape[0] // 2
+    if chunk_size is None:
+        logits = model(input_ids)
+        log_probs = rlhf.get_batch_log_probs(logits, labels)
+        position_logit_means = logits.mean(-1)
+    else:
+        log_probs, position_logit_means = chunked_batch_log_probs(model, input_ids, labels, chunk_size)
+    return (
+        log_probs[:len_chosen],
+        log_probs[len_chosen:],
+        conversation_logits_mean(position_logit_means[:len_chosen], labels[:len_chosen]),
+        conversation_logits_mean(position_logit_means[len_chosen:], labels[len_chosen:]),
+    )
+
+
+@pytest.mark.parametrize("chunk_size", [None, 3])
+def test_shared_prompt_matches_stacked_layout(model, chunk_size):
+    batch = padded_collate_dpo_shared_prompt(BATCH, padding_idx=0, ignore_idx=CROSS_ENTROPY_IGNORE_IDX)
+    with torch.no_grad():
+        expected = _stacked(model)
+        actual = shared_prompt_batch_log_probs(model, batch, chunk_size=chunk_size)
+    for name, a, e in zip(("chosen", "rejected", "logits/chosen", "logits/rejected"), actual, expected):
+        torch.testing.assert_close(a, e, rtol=1e-4, atol=1e-4, msg=name)
+
+
+def test_logit_metrics_agree_across_stacked_paths(model):
+    with torch.no_grad():
+        full = _stacked(model)
+        chunked = _stacked(model, chunk_size=3)
+    for a, e in zip(chunked, full):
+        torch.testing.assert_close(a, e, rtol=1e-4, atol=1e-4)
@@ -0,0 +1,111 @@
+import copy
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("torchtune")
+
+from torchtune.models.llama3 import llama3
+
+import speculative
+from eval_utils import generate_from_prefix, prefill_prefix, trim_at_stop_token
+from speculative import speculative_generate_from_prefix
+
+VOCAB_SIZE = 64
+PAD_ID = 0
+STOP_TOKENS = {1}
+NUM_DRAFT_TOKENS = 4
+MAX_GENERATED_TOKENS = 40
+PREFIX = [5, 9, 17, 33, 2]
+SUFFIXES = [[7, 8, 12], [40, 3], [21, 22, 23, 24, 25], [60]]
+
+
+def _tiny_llama(seed):
+    torch.manual_seed(seed)
+    model = llama3(
+        vocab_size=VOCAB_SIZE,
+        num_layers=2,
+        num_heads=4,
+        num_kv_heads=2,
+        embed_dim=32,
+        max_seq_len=128,
+    )
+    return model.eval()
+
+
+def _perturbed(model, scale, seed):
+    # close to the policy, so most drafts are accepted but some are rejected partway
+    torch.manual_seed(seed)
+    draft = copy.deepcopy(model)
+    with torch.no_grad():
+        for param in draft.parameters():
+            param.add_(torch.randn_like(param) * scale * param.std())
+    return draft
+
+
+def _setup_caches(model, batch_size):
+    seq_len = len(PREFIX) + max(len(s) for s in SUFFIXES) + MAX_GENERATED_TOKENS + NUM_DRAFT_TOKENS
+    model.setup_caches(batch_size=batch_size, dtype=torch.float32, decoder_max_seq_len=seq_len)
+
+
+def _answers(generated):
+    return [trim_at_stop_token(tokens, STOP_TOKENS) for tokens in generated]
+
+
+@pytest.mark.parametrize("draft", ["same", "perturbed", "independent"])
+@pytest.mark.parametrize("batch_size", [1, 4])
+def test_greedy_speculative_matches_greedy(draft, batch_size, monkeypatch):
+    model = _tiny_llama(seed=0)
+    draft_model = {
+        "same": lambda: copy.deepcopy(model),
+        "perturbed": lambda: _perturbed(model, scale=0.05, seed=1),
+        "independent": lambda: _tiny_llama(seed=2),
+    }[draft]()
+    rewinds = []
+
+    def recording_rewind(m, num_tokens):
+        if m is model:
+            rewinds.append(num_tokens)
+        return rewind_kv_caches(m, num_tokens)
+
+    rewind_kv_caches = speculative.rewind_kv_caches
+    monkeypatch.setattr(speculative, "rewind_kv_caches", recording_rewind)
+
+    kwargs = dict(
+        prefix_len=len(PREFIX),
+        batch_size=batch_size,
+        max_generated_tokens=MAX_GENERATED_TOKENS,
+        temperature=0,
+        top_k=None,
+        stop_tokens=STOP_TOKENS,
+        pad_id=PAD_ID,
+    )
+    _setup_caches(model, batch_size)
+    _setup_caches(draft_model, batch_size)
+    expected, actual = [], []
+    with torch.no_grad():
+        for start in range(0, len(SUFFIXES), batch_size):
+            suffixes = SUFFIXES[start : start + batch_size]
+            prefill_prefix(model, PREFIX, batch_size)
+            expected += _answers(generate_from_prefix(model, suffixes=suffixes, **kwargs))
+
+            prefill_prefix(model, PREFIX, batch_size)
+            prefill_prefix(draft_model, PREFIX, batch_size)
+            actual += _answers(
+                speculative_generate_from_prefix(
+                    model,
+                    draft_model,
+                    suffixes=suffixes,
+                    num_draft_tokens=NUM_DRAFT_TOKENS,
+                    **kwargs,
+                )
+            )
+
+    assert actual == expected
+    if draft == "same":
+        assert all(n == 0 for n in rewinds)
+    else:
+        assert any(n > 0 for n in rewinds)
+    if draft == "perturbed":
+        # some rounds accept part of the drafts and rewind only the rest
+        assert any(0 < n < NUM_DRAFT_TOKENS for n in rewinds)